@@ -1,15 +1,22 @@
 import streamlit as st
-import numpy as np
-from src.register_students import register_student
-from src.mark_attendance import mark_attendance
+from src.register_students import register_student, register_students_batched
+from src.mark_attendance import mark_attendance_from_bytes
 from src.utils import save_image, cleanup_temp_image
 from src.database import Database
 from src.faiss_index import FaissIndex
-from src.config import get_input_images_dir, INPUT_IMAGES_DIR, COURSES, STATIC_PATH
-from src.logger import get_logger
+from src.face_model import get_face_model, get_onnx_session
+from src.config import get_student_image_path, COURSES, STATIC_PATH, MAX_UPLOAD_BYTES, SHOW_WARNINGS
+from src.logger import get_logger, configure_logging
 from src.db_setup import init_database
-from datetime import datetime
 import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from functools import partial
+
+# Selectbox options and labels are constant, so build them once instead of on every rerun
+_COURSE_OPTIONS = list(COURSES)
+_COURSE_LABELS = {course_id: f"{course_id} - {course_name}" for course_id, course_name in COURSES.items()}
 
 # ---------- Page Setup ----------
 st.set_page_config(
@@ -20,8 +27,13 @@ st.set_page_config(
 )
 
 # Inject custom CSS
-with open(STATIC_PATH, "r") as f:
-    st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+@st.cache_data(show_spinner=False)
+def load_css(path: str) -> str:
+    """Read a stylesheet once; Streamlit reruns the script on every interaction."""
+    with open(path, "r") as f:
+        return f.read()
+
+st.markdown(f"<style>{load_css(STATIC_PATH)}</style>", unsafe_allow_html=True)
 
 # Hero Section
 st.markdown("""
@@ -82,34 +94,86 @@ with st.sidebar:
     
 
 # ---------- Initialize Logger, DB, FAISS ----------
+configure_logging()
+if not SHOW_WARNINGS:
+    warnings.filterwarnings("ignore")
 logger = get_logger(__name__)
 
-if 'db' not in st.session_state:
+@st.cache_resource(show_spinner=False)
+def get_db() -> Database:
+    """Return the process-wide database connection shared by all sessions."""
     success, message = init_database()
     if not success:
-        st.error(message)
-        st.stop()
-    st.session_state.db = Database()
-    st.session_state.faiss_index = FaissIndex()
-    for course_id in COURSES:
-        students = st.session_state.db.fetch_students(course_id)
-        if students:
-            embeddings = np.array([student['embedding'] for student in students], dtype=np.float32)
-            student_ids = [student['id'] for student in students]
-            names = [student['name'] for student in students]
-            st.session_state.faiss_index.build_index(embeddings, student_ids, names, course_id)
+        raise RuntimeError(message)
+    return Database()
+
+def _hydrate_course(index: FaissIndex, course_id: str) -> None:
+    """
+    Load or rebuild one course's FAISS index, using a SQLite connection owned by the calling thread.
+    A course that fails is logged and left without an index (attendance then falls back to
+    sqlite-vec, if enabled), so it cannot stop the app from starting.
+    """
+    try:
+        with Database() as course_db:
+            # Reuse the persisted index and its roster sidecar unless students changed since it was written
+            token = course_db.student_state_token(course_id)
+            if token and token[0] and index.load_index(course_id, token=token):
+                return
+            student_ids, names = course_db.fetch_student_roster(course_id)
+            embeddings = course_db.fetch_embedding_matrix(course_id) if student_ids else None
+            if embeddings is not None and len(embeddings) == len(student_ids):
+                index.build_index(embeddings, student_ids, names, course_id, token=token)
+                return
+            matrices = course_db.fetch_course_matrices([course_id])
+        if course_id in matrices:
+            student_ids, names, embeddings = matrices[course_id]
+            index.build_index(embeddings, student_ids, names, course_id, token=token)
         else:
-            st.session_state.faiss_index.load_index(course_id)
+            index.load_index(course_id)
+    except Exception as e:
+        logger.error({"course_id": course_id, "error": str(e), "message": "Failed to load FAISS index for course at startup"})
+
+@st.cache_resource(show_spinner="Loading face index...")
+def get_faiss_index() -> FaissIndex:
+    """Return the process-wide FAISS index, hydrated once from the database."""
+    index = FaissIndex()
+    # Courses are independent; SQLite reads and FAISS index building release the GIL
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(COURSES)))) as executor:
+        list(executor.map(partial(_hydrate_course, index), COURSES))
+    return index
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_attendance_records(course_id: str) -> list:
+    """Return a course's attendance records, cached for a minute."""
+    return db.fetch_attendance(course_id)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_attendance_summary(course_id: str, day: str) -> tuple:
+    """Return (present, registered) counts for a course and day, cached for a minute."""
+    return db.attendance_summary(course_id, day)
+
+# Cached instances (created once per server process, deduplicated across reruns)
+try:
+    db = get_db()
+except RuntimeError as e:
+    st.error(str(e))
+    st.stop()
+faiss_index = get_faiss_index()
+
+@st.cache_resource(show_spinner="Loading face recognition model...")
+def warm_up_face_model():
+    """Load and warm up the recognition model (the ONNX Runtime export if there is one) at boot instead of on the first request."""
+    return get_onnx_session() or get_face_model()
 
-# Cached instances
-db = st.session_state.db
-faiss_index = st.session_state.faiss_index
+warm_up_face_model()
 
 # ---------- Tabs ----------
 tab2, tab3, tab4 = st.tabs(["👥 Attendance Registration", "✅ Attendance Marking", "📊 Analytical Dashboard"])
 
 # ---------- Tab 2: Attendance Registration ----------
-with tab2:
+@st.fragment
+def render_registration():
+    """Render the registration tab; its widgets only rerun this fragment."""
     st.markdown("""
     <div class="tab-header">
         <h2>👥 Attendance Registration</h2>
@@ -153,39 +217,97 @@ with tab2:
                 name = st.text_input("Full Name", placeholder="Enter student's full name")
                 roll_no = st.text_input("Roll Number", placeholder="Enter 4-digit roll number (e.g., 1234)")
             with col2:
-                course_id = st.selectbox("Course", options=list(COURSES.keys()), format_func=lambda x: f"{x} - {COURSES[x]}")
+                course_id = st.selectbox("Course", options=_COURSE_OPTIONS, index=None, placeholder="Select a course", format_func=_COURSE_LABELS.get)
                 image_file = st.file_uploader("Upload Face Image", type=["jpg", "jpeg", "png"], help="Upload a clear frontal face image.")
 
             submit_btn = st.form_submit_button("Register Student")
 
     if submit_btn:
         try:
+            # Cheap checks first, so invalid submissions never touch the disk or the embedding model
             roll_no_int = int(roll_no)
             if not (1000 <= roll_no_int <= 9999):
                 st.error("Roll number must be exactly 4 digits (e.g., 1234).")
-            elif not all([name, roll_no, course_id, image_file]):
+            elif not all([name.strip(), course_id, image_file]):
                 st.error("Please complete all fields and upload an image.")
+            elif image_file.size > MAX_UPLOAD_BYTES:
+                st.error(f"Image is too large; the maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+            elif db.check_duplicate(roll_no_int, course_id):
+                st.error(f"❌ Student {roll_no_int} is already registered in course {COURSES[course_id]}")
             else:
-                image_path = os.path.join(get_input_images_dir(course_id), f"{roll_no_int}.jpg")
-                os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                image_path = get_student_image_path(course_id, roll_no_int, name)
                 success, message = save_image(image_file, image_path)
                 if not success:
                     st.error(message)
                 else:
                     course_name = COURSES[course_id]
-                    success, message = register_student(db, roll_no_int, name, course_id, course_name, image_path, faiss_index)
+                    # The saved copy is kept for bootstrapping; extract from the upload already in memory
+                    success, message = register_student(db, roll_no_int, name.strip(), course_id, course_name, image_file, faiss_index)
                     if success:
                         st.success(f"✅ {message}")
                         st.balloons()
                     else:
+                        # Don't leave an unregistered image for bootstrap_course to ingest
+                        cleanup_temp_image(image_path)
                         st.error(f"❌ {message}")
         except ValueError:
             st.error("Roll number must be a valid 4-digit integer.")
         except Exception as e:
             st.error(f"Unexpected error: {str(e)}")
 
+    with st.expander("📚 Bulk Registration", expanded=False):
+        with st.form("bulk_registration_form"):
+            bulk_course_id = st.selectbox("Course", options=_COURSE_OPTIONS, index=None, placeholder="Select a course", format_func=_COURSE_LABELS.get, key="bulk_course")
+            bulk_files = st.file_uploader(
+                "Upload Face Images", type=["jpg", "jpeg", "png"], accept_multiple_files=True,
+                help="Name each file <roll number>_<full name>, e.g. 1234_John Doe.jpg."
+            )
+            bulk_submit_btn = st.form_submit_button("Register Students")
+
+    if bulk_submit_btn:
+        if not bulk_course_id or not bulk_files:
+            st.error("Please select a course and upload at least one image.")
+        else:
+            batch, seen, image_paths = [], set(), {}
+            for bulk_file in bulk_files:
+                roll_part, _, name_part = os.path.splitext(bulk_file.name)[0].partition("_")
+                if not roll_part.isdigit() or not (1000 <= int(roll_part) <= 9999) or not name_part.strip():
+                    st.error(f"❌ {bulk_file.name}: file name must look like 1234_John Doe.jpg")
+                    continue
+                if bulk_file.size > MAX_UPLOAD_BYTES:
+                    st.error(f"❌ {bulk_file.name}: image is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+                    continue
+                # Reject duplicates before saving, so they never overwrite a registered student's image
+                if int(roll_part) in seen:
+                    st.error(f"❌ {bulk_file.name}: student {int(roll_part)} appears more than once in this upload")
+                    continue
+                seen.add(int(roll_part))
+                if db.check_duplicate(int(roll_part), bulk_course_id):
+                    st.error(f"❌ {bulk_file.name}: student {int(roll_part)} is already registered in course {COURSES[bulk_course_id]}")
+                    continue
+                image_path = get_student_image_path(bulk_course_id, int(roll_part), name_part)
+                success, message = save_image(bulk_file, image_path)
+                if not success:
+                    st.error(f"❌ {bulk_file.name}: {message}")
+                    continue
+                batch.append((int(roll_part), name_part.strip(), bulk_file))
+                image_paths[int(roll_part)] = image_path
+
+            if batch:
+                with st.spinner(f"Registering {len(batch)} students..."):
+                    results = register_students_batched(db, batch, bulk_course_id, COURSES[bulk_course_id], faiss_index)
+                    faiss_index.flush(bulk_course_id)
+                for student_id, success, message in results:
+                    if success:
+                        st.success(f"✅ {message}")
+                    else:
+                        cleanup_temp_image(image_paths[student_id])
+                        st.error(f"❌ {student_id}: {message}")
+
 # ---------- Tab 3: Attendance Marking ----------
-with tab3:
+@st.fragment
+def render_attendance():
+    """Render the attendance marking tab; its widgets only rerun this fragment."""
     st.markdown("""
     <div class="tab-header">
         <h2>✅ Attendance Marking</h2>
@@ -223,25 +345,25 @@ with tab3:
         """, unsafe_allow_html=True)
 
     with st.expander("📊 Attendance Detection Form", expanded=True):
-        course_id = st.selectbox("Select Course", options=list(COURSES.keys()), format_func=lambda x: f"{x} - {COURSES[x]}", key="attendance_course")
+        course_id = st.selectbox("Select Course", options=_COURSE_OPTIONS, index=None, placeholder="Select a course", format_func=_COURSE_LABELS.get, key="attendance_course")
         image_to_check = st.file_uploader("Upload Image for Attendance", type=["jpg", "jpeg", "png"], key="attendance_image", help="Upload a single or group photo for recognition.")
 
-        if image_to_check:
+        if image_to_check and not course_id:
+            st.warning("Please select a course first.")
+        elif image_to_check:
             with st.spinner("Processing attendance..."):
-                temp_image_path = os.path.join(INPUT_IMAGES_DIR, f"temp_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg")
-                success, message = save_image(image_to_check, temp_image_path)
-                if not success:
-                    st.error(message)
+                marked, message = mark_attendance_from_bytes(db, image_to_check.getvalue(), faiss_index, course_id)
+                if marked:
+                    load_attendance_records.clear()
+                    load_attendance_summary.clear()
+                    st.success(f"✅ {message}")
                 else:
-                    student_id, name, message = mark_attendance(db, temp_image_path, faiss_index, course_id)
-                    if student_id:
-                        st.success(f"✅ {message}")
-                    else:
-                        st.error(f"❌ {message}")
-                    cleanup_temp_image(temp_image_path)
+                    st.error(f"❌ {message}")
 
 # ---------- Tab 4: Analytical Dashboard ----------
-with tab4:
+@st.fragment
+def render_dashboard():
+    """Render the analytics dashboard tab; its widgets only rerun this fragment."""
     st.markdown("""
     <div class="tab-header">
         <h2>📊 Analytical Dashboard</h2>
@@ -278,27 +400,38 @@ with tab4:
         </div>
         """, unsafe_allow_html=True)
 
-    selected_course = st.selectbox("🎓 Select Course for Dashboard", options=list(COURSES.keys()), format_func=lambda x: f"{x} - {COURSES[x]}", key="dashboard_course")
+    selected_course = st.selectbox("🎓 Select Course for Dashboard", options=_COURSE_OPTIONS, index=None, placeholder="Select a course", format_func=_COURSE_LABELS.get, key="dashboard_course")
+
+    selected_date = st.date_input("📅 Attendance Date", value=date.today(), key="dashboard_date")
 
     if selected_course:
         with st.spinner("Loading attendance data..."):
-            # Fetch attendance records (assuming db has a method fetch_attendance; add if needed in actual impl)
-            # For demo, simulate data
-            # In real code, implement db.fetch_attendance(selected_course)
-            attendance_data = [
-                {"Student ID": 1234, "Name": "John Doe", "Date": "2025-09-06", "Status": "Present"},
-                {"Student ID": 5678, "Name": "Jane Smith", "Date": "2025-09-06", "Status": "Absent"},
-            ]  # Replace with actual db call
+            attendance_data = load_attendance_records(selected_course)
             if attendance_data:
-                st.dataframe(attendance_data, use_container_width=True)
+                st.dataframe(
+                    attendance_data, use_container_width=True,
+                    column_config={"student_id": "Student ID", "name": "Name", "timestamp": "Timestamp"}
+                )
                 st.markdown("#### Attendance Summary")
-                present_count = sum(1 for record in attendance_data if record["Status"] == "Present")
-                total = len(attendance_data)
-                st.progress(present_count / total if total > 0 else 0)
-                st.write(f"Attendance Rate: { (present_count / total * 100) if total > 0 else 0:.2f}%")
+                present_count, total = load_attendance_summary(selected_course, selected_date.isoformat())
+                rate = present_count / total if total > 0 else 0
+                st.progress(min(rate, 1.0))
+                st.write(f"Attendance Rate: {rate * 100:.2f}% ({present_count} of {total} students present on {selected_date})")
             else:
                 st.info("No attendance records found for this course.")
 
+with tab2:
+    render_registration()
+
+with tab3:
+    render_attendance()
+
+with tab4:
+    render_dashboard()
+
 # ---------- Cleanup ----------
 if st.session_state.get('shutdown', False):
-    db.close_connection()
\ No newline at end of file
+    faiss_index.flush()
+    db.close_connection()
+    get_db.clear()
+    get_faiss_index.clear()
\ No newline at end of file
@@ -11,8 +11,13 @@ st.set_page_config(
 )
 
 # Inject custom CSS
-with open("./static/styles.css", "r") as f:
-    st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+@st.cache_data(show_spinner=False)
+def load_css(path: str) -> str:
+    """Read a stylesheet once; Streamlit reruns the script on every interaction."""
+    with open(path, "r") as f:
+        return f.read()
+
+st.markdown(f"<style>{load_css("./static/styles.css")}</style>", unsafe_allow_html=True)
 
 # Hero Section with animated title
 st.markdown("""
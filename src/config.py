@@ -7,20 +7,67 @@ def get_input_images_dir(course_id: str) -> str:
     """Return course-specific training images directory."""
     return os.path.join(INPUT_IMAGES_DIR, course_id)
 
+def get_student_image_path(course_id: str, student_id: int, name: str) -> str:
+    """
+    Return where a registered student's image is saved: <roll number>_<full name>.jpg in the course's
+    input images directory, the naming main.bootstrap_course re-registers from. Characters that are
+    not allowed in file names are replaced with '-'.
+    """
+    file_name = "".join("-" if c in '<>:"/\\|?*' or not c.isprintable() else c for c in name.strip())
+    return os.path.join(get_input_images_dir(course_id), f"{student_id}_{file_name}.jpg")
+
 def get_faiss_index_path(course_id: str) -> str:
     """Return course-specific FAISS index path."""
     return os.path.join("database", f"faiss_index_{course_id}.bin")
 
+def get_onnx_model_path(model_name: str) -> str:
+    """Return the path of a recognition model's ONNX export, as written by face_model.export_onnx_model."""
+    return os.path.join("models", f"{model_name.lower()}.onnx")
+
+def get_faiss_meta_path(course_id: str) -> str:
+    """Return the sidecar path holding a course index's student roster and freshness token."""
+    return os.path.join("database", f"faiss_index_{course_id}.meta.json")
+
 INPUT_IMAGES_DIR = os.path.join("images", "input_imgs")
 TRAIN_IMAGES_DIR = os.path.join("images", "test_imgs")
 LOG_FILE = os.path.join("logs", "attendance.log")
+LOG_LEVEL = os.environ.get("OPTIAUTH_LOG_LEVEL", "WARNING").upper()  # e.g. OPTIAUTH_LOG_LEVEL=DEBUG while developing
+SHOW_WARNINGS = os.environ.get("OPTIAUTH_SHOW_WARNINGS") == "1"  # Entry points silence Python warnings unless set
+ATTENDANCE_AUDIT_DIR = os.path.join("images", "attendance_audit")
+SAVE_ATTENDANCE_IMAGES = False  # Keep a copy of every attendance upload in ATTENDANCE_AUDIT_DIR
 STATIC_PATH = os.path.join("static", "styles.css")
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # Reject uploaded images larger than 10 MB
 DEEPFACE_MODEL = "ArcFace"
+USE_ONNX_RUNTIME = True  # Run the recognition model with ONNX Runtime when it is installed and an export exists
+# Retuned when matching moved to normalized embeddings, not carried over: the original check accepted
+# a squared L2 distance below 0.4 between raw, unnormalized ArcFace embeddings, which accepts a different
+# set of pairs. 0.4 is now the max squared L2 distance between L2-normalized embeddings
 FAISS_THRESHOLD = 0.4
+FAISS_SIM_THRESHOLD = 1 - FAISS_THRESHOLD / 2  # The same bound as a cosine similarity (0.8), since L2² = 2 - 2·cos for unit vectors
 EMBEDDING_DIM = 512
+HNSW_MIN_VECTORS = 1000  # Courses larger than this use FAISS_INDEX_FACTORY instead of an exhaustive scan
+FAISS_SMALL_INDEX_SQ8 = True  # Smaller courses scan 8-bit scalar-quantized codes instead of float32 vectors
+FAISS_INDEX_FACTORY = "HNSW32,SQ8"  # faiss.index_factory description of the large-course index, e.g. "IVF64,PQ16x8"
+QUANTIZE_EMBEDDINGS = True  # Store student embeddings as int8 codes with a per-row scale, 4x smaller than float32
+USE_SQLITE_VEC = True  # Mirror embeddings into a sqlite-vec table (when installed) as an in-database search fallback
+HNSW_EF_CONSTRUCTION = 40
+HNSW_EF_SEARCH = 16
+FAISS_MMAP_INDEXES = True  # Memory-map saved FAISS indexes on load, so processes share them via the page cache
+FAISS_IVF_NPROBE = 8  # Inverted lists scanned per query when FAISS_INDEX_FACTORY is an IVF index
+SEARCH_BATCH_MAX_QUERIES = 64  # Query rows coalesced into one FAISS search across concurrent attendance requests
+SEARCH_BATCH_WINDOW_MS = 5  # How long the search worker waits for more requests when several are already queued
+SEARCH_TIMEOUT_SECONDS = 10  # Attendance requests give up on a search that has not finished by then
+RERANK_CANDIDATES = 10  # Shortlist re-scored against stored embeddings when a course index is approximate; 0 disables
+MATCH_CACHE_SIZE = 256  # Recently matched attendance images whose students are reused without a search; 0 disables
+MATCH_CACHE_TTL_SECONDS = 60  # How long a cached match stays valid
+MAX_FACES_PER_IMAGE = 20  # Faces recognized per group attendance photo
+MAX_IMAGE_EDGE = 1024  # Longer edge images are downscaled to before face detection
+MAX_GROUP_IMAGE_EDGE = 2048  # Same, for group photos where faces are small
+EMBEDDING_CACHE_SIZE = 256  # Recently seen images (by content hash) whose embeddings are reused; 0 disables
+CROP_WORKERS = 4  # Threads cropping eye regions in parallel during batch extraction
 
 COURSES = {
-    "": "",
     "AI": "Artificial Intelligence",
     "GD": "Graphic Design"
-}
\ No newline at end of file
+}
+VALID_COURSE_IDS = frozenset(COURSES)  # O(1) check that rejects unknown course IDs before any database or index work
\ No newline at end of file
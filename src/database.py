@@ -1,16 +1,37 @@
 import sqlite3
+import logging
 import os
-import warnings
+import threading
+import functools
+from contextlib import contextmanager
+from datetime import date, timedelta
 import numpy as np
 from typing import Optional, Tuple, List, Dict
-from src.config import DATABASE_PATH, EMBEDDING_DIM
+from src.config import DATABASE_PATH, EMBEDDING_DIM, QUANTIZE_EMBEDDINGS, USE_SQLITE_VEC
 from src.logger import get_logger
 
+try:
+    import blosc
+except ImportError:  # Blosc is optional; embeddings are then stored uncompressed
+    blosc = None
+
+try:
+    import sqlite_vec
+except ImportError:  # sqlite-vec is optional; vector search then only runs through FAISS
+    sqlite_vec = None
+
 # Configure logging
 logger = get_logger(__name__)
 
-# Ignore warnings
-warnings.filterwarnings("ignore")
+
+def _serialized(method):
+    """Run a Database method while holding its connection lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class Database:
     """
@@ -18,25 +39,95 @@ class Database:
 
     Handles all SQLite interactions for the eye-based attendance system.
     """
+    # Version 3: every student embedding BLOB starts with one of the format bytes below
+    SCHEMA_VERSION = 3
+    _FORMAT_FLOAT32 = 0  # EMBEDDING_DIM raw float32 values
+    _FORMAT_INT8 = 1  # A float32 scale followed by EMBEDDING_DIM int8 codes
+    _FORMAT_BLOSC = 2  # Blosc-compressed float32 values
+    _SQL_CHECK_DUP = "SELECT 1 FROM students WHERE id = ? AND course_id = ?"
+    _SQL_INSERT_STUDENT = "INSERT OR REPLACE INTO students (id, name, course_id, course_name, embedding) VALUES (?, ?, ?, ?, ?)"
+    _SQL_INSERT_ATTENDANCE = "INSERT INTO attendance (student_id, course_id, timestamp) VALUES (?, ?, ?)"
+
     def __init__(self, db_path: str = DATABASE_PATH):
         """🗄️ Initialize and connect to SQLite database."""
         try:
-            logger.debug(f"Connecting to database at {db_path}")
+            logger.debug("Connecting to database at %s", db_path)
             os.makedirs(os.path.dirname(db_path), exist_ok=True)
-            self.connection = sqlite3.connect(db_path, check_same_thread=False)
+            # Autocommit mode: reads run without a transaction, writes open one explicitly
+            self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, cached_statements=256)
             self.connection.row_factory = sqlite3.Row
             self.cursor = self.connection.cursor()
+            # Plain-tuple cursor for hot queries that never look columns up by name
+            self._fast_cursor = self.connection.cursor()
+            self._fast_cursor.row_factory = None
+            # One connection and its two cursors are shared by every thread (e.g. all Streamlit sessions),
+            # so each method uses them under this lock; reentrant so write transactions can nest in it
+            self._lock = threading.RLock()
+            self.configure_connection()
+            self.vec_enabled = self._load_vector_extension()
             self.init_tables()
             logger.info({"message": f"Connected to SQLite database at {db_path}"})
         except sqlite3.Error as e:
             logger.error({"error": str(e), "message": "Database connection failed"})
             raise
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_connection()
+
+    @contextmanager
+    def _write_transaction(self):
+        """🔐 Run the enclosed writes in one BEGIN IMMEDIATE ... COMMIT transaction, rolling back on error."""
+        with self._lock:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.cursor.execute("ROLLBACK")
+                raise
+            self.cursor.execute("COMMIT")
+
+    def _load_vector_extension(self) -> bool:
+        """🧭 Load the sqlite-vec extension if it is installed and enabled; returns whether it is available."""
+        if not USE_SQLITE_VEC or sqlite_vec is None:
+            return False
+        try:
+            self.connection.enable_load_extension(True)
+            sqlite_vec.load(self.connection)
+            self.connection.enable_load_extension(False)
+            logger.debug("sqlite-vec extension loaded")
+            return True
+        except (AttributeError, sqlite3.Error) as e:
+            # AttributeError: this Python's sqlite3 was built without extension loading
+            logger.warning({"error": str(e), "message": "sqlite-vec is installed but could not be loaded"})
+            return False
+
+    def configure_connection(self) -> None:
+        """⚙️ Apply connection PRAGMAs: WAL for concurrent readers, fewer fsyncs, a larger page cache, mmap reads."""
+        try:
+            # Only takes effect on a new database (existing ones keep their page size until VACUUM)
+            self.cursor.execute("PRAGMA page_size=8192")
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            self.cursor.execute("PRAGMA synchronous=NORMAL")
+            self.cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB
+            self.cursor.execute("PRAGMA temp_store=MEMORY")
+            self.cursor.execute("PRAGMA foreign_keys=ON")
+            logger.debug("SQLite connection PRAGMAs applied")
+        except sqlite3.Error as e:
+            logger.warning({"error": str(e), "message": "Failed to apply SQLite PRAGMAs"})
+        try:
+            self.cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+        except sqlite3.Error as e:
+            # Some filesystems do not support memory-mapped I/O; reads fall back to read()
+            logger.warning({"error": str(e), "message": "Failed to enable SQLite memory-mapped I/O"})
+
     def init_tables(self) -> None:
         """📋 Initialize students and attendance tables."""
         try:
             logger.debug("Initializing database tables")
-            with self.connection:
+            with self._write_transaction():
                 self.cursor.execute("""
                     CREATE TABLE IF NOT EXISTS students (
                         id INTEGER NOT NULL,
@@ -47,6 +138,15 @@ class Database:
                         PRIMARY KEY (id, course_id)
                     )
                 """)
+                self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_course ON students (course_id)")
+                # One contiguous float32 (n, EMBEDDING_DIM) matrix per course, rows in students rowid order
+                self.cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS course_matrix (
+                        course_id TEXT PRIMARY KEY,
+                        n INTEGER NOT NULL,
+                        blob BLOB NOT NULL
+                    )
+                """)
                 self.cursor.execute("""
                     CREATE TABLE IF NOT EXISTS attendance (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -56,22 +156,33 @@ class Database:
                         FOREIGN KEY (student_id, course_id) REFERENCES students (id, course_id)
                     )
                 """)
+                self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_course_student ON attendance (course_id, student_id, timestamp)")
+                if self.cursor.execute("PRAGMA user_version").fetchone()[0] < 3:
+                    self._tag_legacy_embeddings()
+                self.cursor.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+                if self.vec_enabled:
+                    self.cursor.execute(f"""
+                        CREATE VIRTUAL TABLE IF NOT EXISTS vec_students USING vec0(
+                            course_id TEXT PARTITION KEY,
+                            embedding float[{EMBEDDING_DIM}] distance_metric=cosine,
+                            +student_id INTEGER
+                        )
+                    """)
+                    self._sync_vec_students()
             logger.info({"message": "Database tables initialized"})
         except sqlite3.Error as e:
             logger.error({"error": str(e), "message": "Failed to initialize tables"})
             raise
 
+    @_serialized
     def check_duplicate(self, student_id: int, course_id: str) -> bool:
         """Check if a student is already registered for a course."""
         try:
-            logger.debug(f"Checking for duplicate student {student_id} in course {course_id}")
-            with self.connection:
-                self.cursor.execute(
-                    "SELECT 1 FROM students WHERE id = ? AND course_id = ?",
-                    (student_id, course_id)
-                )
-                exists = self.cursor.fetchone() is not None
-            logger.debug({"student_id": student_id, "course_id": course_id, "exists": exists, "message": "Duplicate check completed"})
+            logger.debug("Checking for duplicate student %s in course %s", student_id, course_id)
+            self._fast_cursor.execute(self._SQL_CHECK_DUP, (student_id, course_id))
+            exists = self._fast_cursor.fetchone() is not None
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug({"student_id": student_id, "course_id": course_id, "exists": exists, "message": "Duplicate check completed"})
             return exists
         except sqlite3.Error as e:
             logger.error({"error": str(e), "message": f"Error checking duplicate for student {student_id} in course {course_id}"})
@@ -80,12 +191,12 @@ class Database:
     def register_student(self, student_id: int, name: str, course_id: str, course_name: str, embedding: np.ndarray) -> Tuple[bool, str]:
         """📝 Register a student in the database."""
         try:
-            logger.debug(f"Registering student {student_id}, name: {name}, course_id: {course_id}")
+            logger.debug("Registering student %s, name: %s, course_id: %s", student_id, name, course_id)
             if not isinstance(embedding, np.ndarray):
                 logger.error({"type": type(embedding), "message": f"Invalid embedding type for student {student_id}"})
                 raise ValueError("Embedding must be a numpy array")
             
-            embedding = embedding.astype(np.float32)
+            embedding = np.ascontiguousarray(embedding, dtype=np.float32)
             if embedding.shape[0] != EMBEDDING_DIM:
                 logger.error({"got": embedding.shape[0], "expected": EMBEDDING_DIM, "message": f"Unexpected embedding dimension for student {student_id}"})
                 raise ValueError(f"Embedding dimension must be {EMBEDDING_DIM}, got {embedding.shape[0]}")
@@ -96,12 +207,14 @@ class Database:
                 logger.error({"got": len(embedding_bytes), "expected": expected_bytes, "message": f"Unexpected embedding bytes length for student {student_id}"})
                 raise ValueError(f"Embedding bytes length must be {expected_bytes}, got {len(embedding_bytes)}")
             
-            with self.connection:
+            with self._write_transaction():
                 self.cursor.execute(
-                    "INSERT OR REPLACE INTO students (id, name, course_id, course_name, embedding) VALUES (?, ?, ?, ?, ?)",
-                    (student_id, name, course_id, course_name, embedding_bytes)
+                    self._SQL_INSERT_STUDENT,
+                    (student_id, name, course_id, course_name, self._encode_embedding_bytes(embedding_bytes))
                 )
-            logger.info({"student_id": student_id, "course_id": course_id, "message": f"Student {name} registered successfully"})
+                self._append_course_matrix(course_id, embedding_bytes, 1)
+                self._upsert_vec_students(course_id, [(student_id, embedding_bytes)])
+            logger.info("Student %s registered successfully (student_id=%s, course_id=%s)", name, student_id, course_id)
             return True, f"Student {name} (ID: {student_id}) registered successfully for {course_name}"
         except sqlite3.Error as e:
             logger.error({"student_id": student_id, "course_id": course_id, "error": str(e), "message": "Failed to register student"})
@@ -110,29 +223,231 @@ class Database:
             logger.error({"student_id": student_id, "course_id": course_id, "error": str(e), "message": "Unexpected error during student registration"})
             return False, f"Error: {str(e)}"
 
-    def fetch_students(self, course_id: Optional[str] = None) -> Optional[List[Dict]]:
-        """📋 Fetch all students' data, optionally filtered by course_id."""
+    @classmethod
+    def _encode_embedding_bytes(cls, embedding_bytes: bytes) -> bytes:
+        """
+        Encode a raw float32 embedding for storage, behind its format byte. With QUANTIZE_EMBEDDINGS it
+        becomes a float32 scale followed by EMBEDDING_DIM int8 codes (symmetric, per-row max-abs scaling);
+        otherwise it is Blosc-compressed when available, byte shuffling grouping the similar exponent bytes.
+        """
+        if QUANTIZE_EMBEDDINGS:
+            embedding = np.frombuffer(embedding_bytes, dtype=np.float32)
+            scale = np.float32(np.abs(embedding).max() / 127.0) or np.float32(1.0)
+            codes = np.rint(embedding / scale).astype(np.int8)
+            return bytes((cls._FORMAT_INT8,)) + scale.tobytes() + codes.tobytes()
+        if blosc is None:
+            return bytes((cls._FORMAT_FLOAT32,)) + embedding_bytes
+        return bytes((cls._FORMAT_BLOSC,)) + blosc.compress(embedding_bytes, typesize=4, cname='lz4', shuffle=blosc.SHUFFLE)
+
+    @classmethod
+    def _check_embedding_bytes(cls, student: Dict) -> bytes:
+        """Decode according to its format byte and validate the length of a student's raw float32 embedding BLOB."""
+        stored = student['embedding']
+        expected_bytes = EMBEDDING_DIM * 4
+        embedding_format, embedding_bytes = (stored[0], stored[1:]) if stored else (None, b"")
+        if embedding_format == cls._FORMAT_INT8:
+            scale = np.frombuffer(embedding_bytes, dtype=np.float32, count=1)[0]
+            codes = np.frombuffer(embedding_bytes, dtype=np.int8, offset=4)
+            embedding_bytes = (codes.astype(np.float32) * scale).tobytes()
+        elif embedding_format == cls._FORMAT_BLOSC:
+            if blosc is None:
+                logger.error({"student_id": student['id'], "got": len(embedding_bytes), "message": "Compressed embedding in database but blosc is not installed"})
+                raise ValueError(f"Embedding for student {student['id']} is Blosc-compressed; install blosc to read it")
+            embedding_bytes = blosc.decompress(embedding_bytes)
+        elif embedding_format != cls._FORMAT_FLOAT32:
+            logger.error({"student_id": student['id'], "format": embedding_format, "got": len(stored), "message": "Unknown embedding format in database"})
+            raise ValueError(f"Unknown embedding format {embedding_format} for student {student['id']}")
+        if len(embedding_bytes) != expected_bytes:
+            logger.error({"student_id": student['id'], "got": len(embedding_bytes), "expected": expected_bytes, "message": "Unexpected embedding bytes length in database"})
+            raise ValueError(f"Unexpected embedding bytes length {len(embedding_bytes)} for student {student['id']}, expected {expected_bytes}")
+        return embedding_bytes
+
+    @classmethod
+    def _legacy_embedding_format(cls, stored: bytes) -> int:
+        """
+        Infer the format of an embedding BLOB written before format bytes (schema version 3), when
+        it could only be told from its length: Blosc if it decompresses to a float32 embedding,
+        raw float32 if it is exactly that long, int8 codes if it has their length, else Blosc.
+        """
+        if blosc is not None:
+            try:
+                if len(blosc.decompress(stored)) == EMBEDDING_DIM * 4:
+                    return cls._FORMAT_BLOSC
+            except Exception:
+                pass
+        if len(stored) == EMBEDDING_DIM * 4:
+            return cls._FORMAT_FLOAT32
+        if len(stored) == EMBEDDING_DIM + 4:
+            return cls._FORMAT_INT8
+        return cls._FORMAT_BLOSC
+
+    def _tag_legacy_embeddings(self) -> None:
+        """Prefix every embedding BLOB of an older database with its format byte, inside the caller's transaction."""
+        self.cursor.execute("SELECT rowid, embedding FROM students")
+        rows = [(bytes((self._legacy_embedding_format(row['embedding']),)) + row['embedding'], row['rowid']) for row in self.cursor.fetchall()]
+        if rows:
+            logger.info({"count": len(rows), "message": "Migrating students table: tagging embedding BLOBs with their format"})
+            # Updating a column keeps the rowid, so course matrices and freshness tokens stay valid
+            self.cursor.executemany("UPDATE students SET embedding = ? WHERE rowid = ?", rows)
+
+    @staticmethod
+    def _student_id(value, course_id: str = None) -> Optional[int]:
+        """
+        Return a stored student ID as an int. Databases created before IDs were declared INTEGER hold
+        them as TEXT; IDs that do not read back as the same integer (e.g. 'khan' or '032') are logged
+        and reported as None, so callers skip those rows instead of indexing IDs that never match.
+        """
+        if isinstance(value, int):
+            return value
+        if isinstance(value, str) and value.isdigit() and str(int(value)) == value:
+            return int(value)
+        logger.warning({"student_id": value, "course_id": course_id, "message": "Skipping student whose ID is not an integer"})
+        return None
+
+    @staticmethod
+    def _decode_embedding(student: Dict) -> np.ndarray:
+        """Decode and validate a student's embedding BLOB."""
+        embedding_bytes = Database._check_embedding_bytes(student)
+        embedding = np.frombuffer(embedding_bytes, dtype=np.float32)
+        if embedding.shape[0] != EMBEDDING_DIM:
+            logger.error({"student_id": student['id'], "got": embedding.shape[0], "expected": EMBEDDING_DIM, "message": "Unexpected embedding dimension in database"})
+            raise ValueError(f"Unexpected embedding dimension {embedding.shape[0]} for student {student['id']}, expected {EMBEDDING_DIM}")
+        return embedding
+
+    def _append_course_matrix(self, course_id: str, embedding_bytes: bytes, count: int) -> None:
+        """
+        Append freshly inserted embeddings to a course's matrix BLOB, inside the caller's transaction.
+
+        When the stored matrix no longer lines up with the students table (a legacy database, or a
+        re-registration that moved a row), the rows inserted before this call are rebuilt from the
+        per-student BLOBs instead (dequantized, with QUANTIZE_EMBEDDINGS); the fresh rows, which got
+        the highest rowids, are always appended as given.
+        """
+        self.cursor.execute("SELECT n, blob FROM course_matrix WHERE course_id = ?", (course_id,))
+        matrix = self.cursor.fetchone()
+        self.cursor.execute("SELECT COUNT(*) AS n FROM students WHERE course_id = ?", (course_id,))
+        total = self.cursor.fetchone()['n']
+        if matrix is not None and matrix['n'] + count == total:
+            blob = matrix['blob'] + embedding_bytes
+        elif matrix is None and count == total:
+            blob = embedding_bytes
+        else:
+            logger.info({"course_id": course_id, "message": "Rebuilding course embedding matrix from students table"})
+            self.cursor.execute("SELECT id, embedding FROM students WHERE course_id = ? ORDER BY rowid LIMIT ?", (course_id, total - count))
+            blob = b"".join(self._check_embedding_bytes(row) for row in self.cursor) + embedding_bytes
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO course_matrix (course_id, n, blob) VALUES (?, ?, ?)",
+            (course_id, total, blob)
+        )
+
+    def _upsert_vec_students(self, course_id: str, rows: List[Tuple[int, bytes]]) -> None:
+        """Mirror (student_id, raw embedding bytes) rows into vec_students, inside the caller's transaction."""
+        if not self.vec_enabled:
+            return
+        self.cursor.executemany(
+            "DELETE FROM vec_students WHERE course_id = ? AND student_id = ?",
+            [(course_id, student_id) for student_id, _ in rows]
+        )
+        self.cursor.executemany(
+            "INSERT INTO vec_students (course_id, embedding, student_id) VALUES (?, ?, ?)",
+            [(course_id, embedding_bytes, student_id) for student_id, embedding_bytes in rows]
+        )
+
+    def _sync_vec_students(self) -> None:
+        """Rebuild vec_students from the students table when their row counts disagree (e.g. an older database)."""
+        self.cursor.execute("SELECT (SELECT COUNT(*) FROM students) AS students, (SELECT COUNT(*) FROM vec_students) AS vectors")
+        counts = self.cursor.fetchone()
+        if counts['students'] == counts['vectors']:
+            return
+        logger.info({"students": counts['students'], "vectors": counts['vectors'], "message": "Rebuilding sqlite-vec table from students table"})
+        self.cursor.execute("DELETE FROM vec_students")
+        self.cursor.execute("SELECT id, course_id, embedding FROM students ORDER BY rowid")
+        rows = [
+            (row['course_id'], self._check_embedding_bytes(row), student_id)
+            for row in self.cursor.fetchall()
+            if (student_id := self._student_id(row['id'], row['course_id'])) is not None
+        ]
+        self.cursor.executemany("INSERT INTO vec_students (course_id, embedding, student_id) VALUES (?, ?, ?)", rows)
+
+    def register_students_bulk(self, students: List[Tuple[int, str]], course_id: str, course_name: str, embeddings: np.ndarray) -> Tuple[bool, str]:
+        """📝 Register several students of one course in a single transaction."""
         try:
-            logger.debug(f"Fetching students from database, course_id: {course_id if course_id else 'all'}")
-            with self.connection:
-                if course_id:
-                    self.cursor.execute("SELECT id, name, course_id, course_name, embedding FROM students WHERE course_id = ?", (course_id,))
-                else:
-                    self.cursor.execute("SELECT id, name, course_id, course_name, embedding FROM students")
-                students = [dict(row) for row in self.cursor.fetchall()]
+            logger.debug("Registering %s students in bulk for course_id: %s", len(students), course_id)
+            if not isinstance(embeddings, np.ndarray):
+                logger.error({"type": type(embeddings), "message": "Invalid embeddings type for bulk registration"})
+                raise ValueError("Embeddings must be a numpy array")
+            
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            if embeddings.ndim != 2 or embeddings.shape[1] != EMBEDDING_DIM:
+                logger.error({"got": embeddings.shape, "expected": EMBEDDING_DIM, "message": "Unexpected embedding dimension for bulk registration"})
+                raise ValueError(f"Embedding dimension must be {EMBEDDING_DIM}, got {embeddings.shape}")
+            
+            if embeddings.shape[0] != len(students):
+                logger.error({"embeddings_count": embeddings.shape[0], "students_count": len(students), "message": "Mismatch in lengths"})
+                raise ValueError("Students and embeddings must have the same length")
+            
+            # Serialize the stacked matrix once and slice each student's BLOB out of it
+            embeddings_bytes = embeddings.tobytes()
+            row_bytes = EMBEDDING_DIM * 4
+            rows = [
+                (student_id, name, course_id, course_name, self._encode_embedding_bytes(embeddings_bytes[i * row_bytes:(i + 1) * row_bytes]))
+                for i, (student_id, name) in enumerate(students)
+            ]
+            with self._write_transaction():
+                self.cursor.executemany(
+                    self._SQL_INSERT_STUDENT,
+                    rows
+                )
+                self._append_course_matrix(course_id, embeddings_bytes, len(rows))
+                self._upsert_vec_students(course_id, [
+                    (student_id, embeddings_bytes[i * row_bytes:(i + 1) * row_bytes])
+                    for i, (student_id, _) in enumerate(students)
+                ])
+            logger.info("Students registered in bulk (count=%s, course_id=%s)", len(rows), course_id)
+            return True, f"{len(rows)} students registered successfully for {course_name}"
+        except sqlite3.Error as e:
+            logger.error({"course_id": course_id, "error": str(e), "message": "Failed to register students in bulk"})
+            return False, f"Database error: {str(e)}"
+        except Exception as e:
+            logger.error({"course_id": course_id, "error": str(e), "message": "Unexpected error during bulk student registration"})
+            return False, f"Error: {str(e)}"
+
+    @_serialized
+    def fetch_students(self, course_id: Optional[str] = None, return_matrix: bool = False):
+        """
+        📋 Fetch all students' data, optionally filtered by course_id.
+
+        With return_matrix=True, returns (student_ids, names, embeddings) instead of per-student dicts,
+        the embeddings copied row by row into one preallocated (N, EMBEDDING_DIM) float32 buffer
+        ready for FaissIndex.build_index.
+        """
+        try:
+            logger.debug("Fetching students from database, course_id: %s", course_id if course_id else 'all')
+            columns = "id, name, embedding" if return_matrix else "id, name, course_id, course_name, embedding"
+            if course_id:
+                self.cursor.execute(f"SELECT {columns} FROM students WHERE course_id = ? ORDER BY rowid", (course_id,))
+            else:
+                self.cursor.execute(f"SELECT {columns} FROM students ORDER BY rowid")
+            rows = self.cursor.fetchall()
+            if return_matrix:
+                if not rows:
+                    return None
+                student_ids, names = [], []
+                embeddings = np.empty((len(rows), EMBEDDING_DIM), dtype=np.float32)
+                for row in rows:
+                    student_id = self._student_id(row['id'], course_id)
+                    if student_id is None:
+                        continue
+                    embeddings[len(student_ids)] = np.frombuffer(self._check_embedding_bytes(row), dtype=np.float32)
+                    student_ids.append(student_id)
+                    names.append(row['name'])
+                if not student_ids:
+                    return None
+                logger.info({"count": len(student_ids), "course_id": course_id if course_id else "all", "message": "Fetched student embedding matrix"})
+                return student_ids, names, embeddings[:len(student_ids)]
+            students = [dict(row) for row in rows]
             for student in students:
-                embedding_bytes = student['embedding']
-                expected_bytes = EMBEDDING_DIM * 4
-                if len(embedding_bytes) != expected_bytes:
-                    logger.error({"student_id": student['id'], "got": len(embedding_bytes), "expected": expected_bytes, "message": "Unexpected embedding bytes length in database"})
-                    raise ValueError(f"Unexpected embedding bytes length {len(embedding_bytes)} for student {student['id']}, expected {expected_bytes}")
-                
-                embedding = np.frombuffer(embedding_bytes, dtype=np.float32)
-                if embedding.shape[0] != EMBEDDING_DIM:
-                    logger.error({"student_id": student['id'], "got": embedding.shape[0], "expected": EMBEDDING_DIM, "message": "Unexpected embedding dimension in database"})
-                    raise ValueError(f"Unexpected embedding dimension {embedding.shape[0]} for student {student['id']}, expected {EMBEDDING_DIM}")
-                
-                student['embedding'] = embedding
+                student['embedding'] = self._decode_embedding(student)
             logger.info({"count": len(students), "course_id": course_id if course_id else "all", "message": "Fetched student data"})
             return students or None
         except sqlite3.Error as e:
@@ -142,16 +457,193 @@ class Database:
             logger.error({"error": str(e), "message": "Unexpected error fetching students"})
             return None
 
+    @_serialized
+    def fetch_course_matrices(self, course_ids: List[str]) -> Dict[str, Tuple[List[int], List[str], np.ndarray]]:
+        """
+        📋 Fetch (student_ids, names, embeddings) per course, ready for FaissIndex.build_index.
+
+        Embedding matrices are preallocated from per-course counts and filled in a single pass
+        over the cursor, so no per-student dicts or arrays are built. Courses without students are omitted.
+        """
+        if not course_ids:
+            return {}
+        try:
+            logger.debug("Fetching embedding matrices for courses: %s", course_ids)
+            placeholders = ", ".join("?" for _ in course_ids)
+            self.cursor.execute(
+                f"SELECT course_id, COUNT(*) AS n FROM students WHERE course_id IN ({placeholders}) GROUP BY course_id",
+                tuple(course_ids)
+            )
+            matrices = {
+                row['course_id']: ([], [], np.empty((row['n'], EMBEDDING_DIM), dtype=np.float32))
+                for row in self.cursor.fetchall()
+            }
+            self.cursor.execute(
+                f"SELECT id, name, course_id, embedding FROM students WHERE course_id IN ({placeholders}) ORDER BY rowid",
+                tuple(course_ids)
+            )
+            for row in self.cursor:
+                student_id = self._student_id(row['id'], row['course_id'])
+                if student_id is None:
+                    continue
+                student_ids, names, embeddings = matrices[row['course_id']]
+                embeddings[len(student_ids)] = np.frombuffer(self._check_embedding_bytes(row), dtype=np.float32)
+                student_ids.append(student_id)
+                names.append(row['name'])
+            # Trim the rows reserved for skipped students, and drop courses left without any
+            matrices = {
+                course_id: (student_ids, names, embeddings[:len(student_ids)])
+                for course_id, (student_ids, names, embeddings) in matrices.items() if student_ids
+            }
+            logger.info({"counts": {course_id: len(ids) for course_id, (ids, _, _) in matrices.items()}, "message": "Fetched embedding matrices"})
+            return matrices
+        except sqlite3.Error as e:
+            logger.error({"error": str(e), "message": "Error fetching embedding matrices"})
+            return {}
+        except Exception as e:
+            logger.error({"error": str(e), "message": "Unexpected error fetching embedding matrices"})
+            return {}
+
+    @_serialized
+    def fetch_embedding_matrix(self, course_id: str) -> Optional[np.ndarray]:
+        """
+        📦 Fetch a course's embeddings as one (n, EMBEDDING_DIM) float32 matrix, in fetch_student_roster order
+        (when both have the same length; the roster skips students whose ID is not an integer).
+
+        The matrix is a read-only view over the stored BLOB, decoded with a single np.frombuffer.
+        Returns None if the course has no matrix yet or it is out of step with the students table.
+        """
+        try:
+            logger.debug("Fetching embedding matrix for course %s", course_id)
+            self.cursor.execute("""
+                SELECT m.n, m.blob, (SELECT COUNT(*) FROM students WHERE course_id = m.course_id) AS total
+                FROM course_matrix m WHERE m.course_id = ?
+            """, (course_id,))
+            row = self.cursor.fetchone()
+            if row is None or row['n'] != row['total'] or len(row['blob']) != row['n'] * EMBEDDING_DIM * 4:
+                logger.warning({"course_id": course_id, "message": "Embedding matrix missing or stale"})
+                return None
+            embeddings = np.frombuffer(row['blob'], dtype=np.float32).reshape(row['n'], EMBEDDING_DIM)
+            logger.info({"count": row['n'], "course_id": course_id, "message": "Fetched embedding matrix"})
+            return embeddings
+        except sqlite3.Error as e:
+            logger.error({"error": str(e), "message": f"Error fetching embedding matrix for course {course_id}"})
+            return None
+
+    @_serialized
+    def search_embeddings(self, course_id: str, embeddings: np.ndarray, k: int = 1) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        🔎 Find the k most similar students of a course for each query embedding, inside SQLite via sqlite-vec.
+        Returns (cosine similarities, student IDs) shaped (N, k) like FaissIndex.search, padded with -1 IDs,
+        or (None, None) if sqlite-vec is unavailable.
+        """
+        if not self.vec_enabled:
+            return None, None
+        try:
+            queries = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+            similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+            ids = np.full((len(queries), k), -1, dtype=np.int64)
+            for i, query in enumerate(queries):
+                self.cursor.execute(
+                    "SELECT student_id, distance FROM vec_students WHERE embedding MATCH ? AND k = ? AND course_id = ? ORDER BY distance",
+                    (query.tobytes(), k, course_id)
+                )
+                for j, row in enumerate(self.cursor.fetchall()):
+                    ids[i, j] = row['student_id']
+                    similarities[i, j] = 1.0 - row['distance']  # cosine distance = 1 - cosine similarity
+            logger.debug("sqlite-vec search over course %s for %s queries", course_id, len(queries))
+            return similarities, ids
+        except sqlite3.Error as e:
+            logger.error({"error": str(e), "message": f"sqlite-vec search failed for course {course_id}"})
+            return None, None
+
+    @_serialized
+    def fetch_student_roster(self, course_id: str) -> Tuple[List[int], List[str]]:
+        """📋 Fetch student IDs and names for a course, in FAISS insertion order, without embeddings."""
+        try:
+            logger.debug("Fetching student roster for course %s", course_id)
+            self.cursor.execute("SELECT id, name FROM students WHERE course_id = ? ORDER BY rowid", (course_id,))
+            rows = [
+                (student_id, row['name']) for row in self.cursor.fetchall()
+                if (student_id := self._student_id(row['id'], course_id)) is not None
+            ]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug({"count": len(rows), "course_id": course_id, "message": "Fetched student roster"})
+            return [student_id for student_id, _ in rows], [name for _, name in rows]
+        except sqlite3.Error as e:
+            logger.error({"error": str(e), "message": f"Error fetching student roster for course {course_id}"})
+            return [], []
+
+    @_serialized
+    def fetch_embeddings(self, course_id: str, student_ids: List[int]) -> Dict[int, np.ndarray]:
+        """
+        🧬 Fetch the stored float32 embeddings of specific students of a course, keyed by student ID.
+
+        Rows are read out of the course matrix BLOB with incremental blob I/O, so only the requested
+        rows are copied. If the matrix is missing or stale, the per-student BLOBs are decoded instead;
+        with QUANTIZE_EMBEDDINGS those (like matrix rows rebuilt by _append_course_matrix) are within
+        max|x| / 254 of the registered embedding per component.
+        """
+        try:
+            if not student_ids:
+                return {}
+            placeholders = ", ".join("?" * len(student_ids))
+            row_bytes = EMBEDDING_DIM * 4
+            self.cursor.execute("""
+                SELECT m.rowid AS matrix_rowid, m.n, length(m.blob) AS size,
+                       (SELECT COUNT(*) FROM students WHERE course_id = m.course_id) AS total
+                FROM course_matrix m WHERE m.course_id = ?
+            """, (course_id,))
+            matrix = self.cursor.fetchone()
+            if matrix is not None and matrix['n'] == matrix['total'] and matrix['size'] == matrix['n'] * row_bytes:
+                # A student's matrix row is the number of course students inserted before them
+                self.cursor.execute(f"""
+                    SELECT s.id, (SELECT COUNT(*) FROM students t WHERE t.course_id = s.course_id AND t.rowid < s.rowid) AS position
+                    FROM students s WHERE s.course_id = ? AND s.id IN ({placeholders})
+                """, (course_id, *student_ids))
+                positions = self.cursor.fetchall()
+                embeddings = {}
+                with self.connection.blobopen("course_matrix", "blob", matrix['matrix_rowid'], readonly=True) as blob:
+                    for row in positions:
+                        blob.seek(row['position'] * row_bytes)
+                        embeddings[self._student_id(row['id'], course_id)] = np.frombuffer(blob.read(row_bytes), dtype=np.float32)
+                return embeddings
+            self.cursor.execute(f"SELECT id, embedding FROM students WHERE course_id = ? AND id IN ({placeholders})", (course_id, *student_ids))
+            return {self._student_id(row['id'], course_id): self._decode_embedding(row) for row in self.cursor.fetchall()}
+        except (sqlite3.Error, ValueError) as e:
+            logger.error({"error": str(e), "message": f"Error fetching embeddings for course {course_id}"})
+            return {}
+
+    @_serialized
+    def course_student_count(self, course_id: str) -> int:
+        """🔢 Return the number of students registered in a course (0 on error), answered from idx_students_course."""
+        try:
+            self._fast_cursor.execute("SELECT COUNT(*) FROM students WHERE course_id = ?", (course_id,))
+            return self._fast_cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error({"error": str(e), "message": f"Error counting students for course {course_id}"})
+            return 0
+
+    @_serialized
+    def student_state_token(self, course_id: str) -> Optional[Tuple[int, int]]:
+        """🕒 Return a cheap (count, max rowid) token that changes whenever a course's students change, or None on error."""
+        try:
+            self._fast_cursor.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM students WHERE course_id = ?", (course_id,))
+            return self._fast_cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error({"error": str(e), "message": f"Error fetching student state token for course {course_id}"})
+            return None
+
     def mark_attendance(self, student_id: int, timestamp: str, course_id: str) -> Tuple[bool, str]:
         """✅ Mark attendance for a student."""
         try:
-            logger.debug(f"Marking attendance for student_id: {student_id}, course_id: {course_id}, timestamp: {timestamp}")
-            with self.connection:
-                self.cursor.execute(
-                    "INSERT INTO attendance (student_id, course_id, timestamp) VALUES (?, ?, ?)",
+            logger.debug("Marking attendance for student_id: %s, course_id: %s, timestamp: %s", student_id, course_id, timestamp)
+            with self._write_transaction():
+                self._fast_cursor.execute(
+                    self._SQL_INSERT_ATTENDANCE,
                     (student_id, course_id, timestamp)
                 )
-            logger.info({"student_id": student_id, "course_id": course_id, "message": "Attendance marked"})
+            logger.info("Attendance marked (student_id=%s, course_id=%s)", student_id, course_id)
             return True, f"Attendance marked for student {student_id} in course {course_id}"
         except sqlite3.Error as e:
             logger.error({"student_id": student_id, "course_id": course_id, "error": str(e), "message": "Error marking attendance"})
@@ -160,6 +652,51 @@ class Database:
             logger.error({"student_id": student_id, "course_id": course_id, "error": str(e), "message": "Unexpected error marking attendance"})
             return False, f"Error: {str(e)}"
 
+    @_serialized
+    def fetch_attendance(self, course_id: str, limit: Optional[int] = None) -> List[Dict]:
+        """📊 Fetch attendance records for a course, newest first, with student names."""
+        try:
+            logger.debug("Fetching attendance records for course %s", course_id)
+            query = """
+                SELECT a.student_id, s.name, a.timestamp
+                FROM attendance a
+                LEFT JOIN students s ON s.id = a.student_id AND s.course_id = a.course_id
+                WHERE a.course_id = ?
+                ORDER BY a.timestamp DESC
+            """
+            params = (course_id,)
+            if limit is not None:
+                query += " LIMIT ?"
+                params += (limit,)
+            self.cursor.execute(query, params)
+            records = [dict(row) for row in self.cursor.fetchall()]
+            logger.info({"count": len(records), "course_id": course_id, "message": "Fetched attendance records"})
+            return records
+        except sqlite3.Error as e:
+            logger.error({"error": str(e), "message": f"Error fetching attendance for course {course_id}"})
+            return []
+
+    @_serialized
+    def attendance_summary(self, course_id: str, day: Optional[str] = None) -> Tuple[int, int]:
+        """📈 Return (students present on day, students registered) for a course, aggregated in SQL."""
+        try:
+            day = day or date.today().isoformat()
+            next_day = (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+            logger.debug("Computing attendance summary for course %s on %s", course_id, day)
+            self.cursor.execute("""
+                SELECT
+                    (SELECT COUNT(DISTINCT student_id) FROM attendance
+                     WHERE course_id = ? AND timestamp >= ? AND timestamp < ?) AS present,
+                    (SELECT COUNT(*) FROM students WHERE course_id = ?) AS total
+            """, (course_id, day, next_day, course_id))
+            row = self.cursor.fetchone()
+            logger.debug({"course_id": course_id, "day": day, "present": row['present'], "total": row['total'], "message": "Attendance summary computed"})
+            return row['present'], row['total']
+        except (sqlite3.Error, ValueError) as e:
+            logger.error({"error": str(e), "message": f"Error computing attendance summary for course {course_id}"})
+            return 0, 0
+
+    @_serialized
     def close_connection(self):
         """🔒 Close SQLite connection."""
         try:
@@ -1,10 +1,6 @@
-import warnings
 from src.database import Database
 from src.logger import get_logger
 
-# Ignore warnings
-warnings.filterwarnings("ignore")
-
 # Configure logging
 logger = get_logger(__name__)
 
@@ -1,13 +1,64 @@
+import io
+import os
+import hashlib
 import cv2
 from deepface import DeepFace
+from deepface.modules import preprocessing
 import mediapipe as mp
 import numpy as np
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from src.logger import get_logger
-from src.config import DEEPFACE_MODEL
+from src.face_model import get_face_model, get_onnx_session
+from src.config import DEEPFACE_MODEL, MAX_FACES_PER_IMAGE, MAX_IMAGE_EDGE, MAX_GROUP_IMAGE_EDGE, CROP_WORKERS, EMBEDDING_CACHE_SIZE
 
 # Configure logging
 logger = get_logger(__name__)
 
+# Face Mesh landmark indices outlining the left (first 7) and right (last 7) eye
+_EYE_IDX = np.array([33, 133, 160, 159, 158, 157, 173, 362, 382, 387, 386, 385, 384, 398])
+
+# FaceMesh graphs are expensive to build and not safe to share between threads, so each thread
+# keeps one instance per max_faces setting, plus a scratch buffer for the RGB copy of each frame
+_face_meshes = threading.local()
+
+# Long-lived threads all cropping runs on, so their cached FaceMesh outlive a request: Streamlit runs
+# every rerun on a new script thread, whose thread-locals would be rebuilt each time. OpenCV and
+# MediaPipe release the GIL, so batches are also cropped in parallel here
+_crop_executor = ThreadPoolExecutor(max_workers=CROP_WORKERS, thread_name_prefix="eye-crop")
+
+# (extractor, arguments, image content digest) -> successful extraction result, least recently used first
+_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+def _rgb_scratch(img):
+    """
+    Return this thread's reusable RGB buffer shaped like img, reallocating only when the shape changes.
+    MediaPipe copies its input into its own image frame, so the buffer can be overwritten on the next call.
+    """
+    buffer = getattr(_face_meshes, "rgb_buffer", None)
+    if buffer is None or buffer.shape != img.shape:
+        buffer = _face_meshes.rgb_buffer = np.empty_like(img)
+    return buffer
+
+def get_face_mesh(max_faces=1):
+    """
+    Return this thread's cached MediaPipe FaceMesh for max_faces faces, creating it on first use;
+    the extractors only crop on _crop_executor's (or a bulk pool's) threads, so instances are reused.
+    static_image_mode makes every call run detection afresh, since consecutive images are unrelated.
+    """
+    meshes = getattr(_face_meshes, "by_max_faces", None)
+    if meshes is None:
+        meshes = _face_meshes.by_max_faces = {}
+    face_mesh = meshes.get(max_faces)
+    if face_mesh is None:
+        logger.debug("Creating MediaPipe FaceMesh for up to %s faces", max_faces)
+        face_mesh = meshes[max_faces] = mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=True, max_num_faces=max_faces, refine_landmarks=False, min_detection_confidence=0.5
+        )
+    return face_mesh
+
 def preprocess_eye_region(img):
     """
     Preprocess eye region for consistent embedding extraction.
@@ -15,67 +66,180 @@ def preprocess_eye_region(img):
     try:
         logger.debug("Starting eye region preprocessing")
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        equalized = cv2.equalizeHist(gray)
-        result = cv2.cvtColor(equalized, cv2.COLOR_GRAY2RGB)
-        logger.debug(f"Eye region preprocessing completed, shape: {result.shape}")
+        cv2.equalizeHist(gray, gray)
+        # Replicate the equalized channel directly; for a gray image RGB and BGR are the same bytes
+        result = cv2.merge((gray, gray, gray))
+        logger.debug("Eye region preprocessing completed, shape: %s", result.shape)
         return result
     except Exception as e:
         logger.error({"error": str(e), "message": "Failed to preprocess eye region"})
         return None
 
-def crop_both_eyes_region_mediapipe(image_input):
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...); they carry the image size
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+# Bytes read from the start of an image file to find its JPEG header; EXIF segments can run to 64 KB each
+_JPEG_HEADER_PROBE_BYTES = 256 * 1024
+
+def _jpeg_size(data):
+    """Return (height, width) from a JPEG's start-of-frame header by walking its marker segments, or None."""
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker in _JPEG_SOF_MARKERS:
+            return (data[i + 5] << 8) | data[i + 6], (data[i + 7] << 8) | data[i + 8]
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+def decode_image(buffer, max_edge=None):
     """
-    Extract eye region from an image using MediaPipe Face Mesh.
-    Returns cropped eye region and bounding box coordinates.
+    Decode a BGR image from an encoded uint8 buffer. With max_edge, a JPEG is decoded at the smallest
+    1/2, 1/4 or 1/8 scale whose longer edge still covers max_edge; libjpeg scales during the IDCT,
+    so decode time and memory shrink with the square of the factor.
+    Returns the image, or None if it could not be decoded.
+    """
+    return cv2.imdecode(buffer, _decode_flags(memoryview(buffer), max_edge))
+
+def _decode_flags(header, max_edge):
+    """Pick the OpenCV imread flags for an image starting with header bytes, per decode_image."""
+    size = _jpeg_size(header) if max_edge is not None else None
+    if size is not None:
+        for factor, reduced_flags in _REDUCED_DECODE_FLAGS:
+            if max(size) // factor >= max_edge:
+                logger.debug("Decoding %sx%s JPEG at 1/%s scale", size[1], size[0], factor)
+                return reduced_flags
+    return cv2.IMREAD_COLOR
+
+def load_image(image_input, max_edge=None):
+    """
+    Load a BGR image from a file path, a file-like object, or an already decoded image array.
+    Pass the longer edge the caller will downscale to, so large JPEGs can be decoded at reduced size.
+    Returns the image, or None if it could not be decoded.
+    """
+    if isinstance(image_input, np.ndarray):
+        logger.debug("Using already decoded image")
+        return image_input
+    if isinstance(image_input, str):
+        logger.debug("Loading image from %s", image_input)
+        if max_edge is None:
+            return cv2.imread(image_input)
+        # Only the header is read here; OpenCV streams the file itself, so it is never buffered whole
+        try:
+            with open(image_input, "rb") as f:
+                header = f.read(_JPEG_HEADER_PROBE_BYTES)
+        except OSError:
+            return None
+        return cv2.imread(image_input, _decode_flags(header, max_edge))
+    logger.debug("Loading image from file-like object")
+    return decode_image(np.frombuffer(image_input.read(), dtype=np.uint8), max_edge)
+
+def downscale_image(img, max_edge):
+    """
+    Shrink an image so its longer edge is at most max_edge pixels, preserving aspect ratio.
+    Smaller images are returned unchanged.
+    """
+    h, w = img.shape[:2]
+    if max(h, w) <= max_edge:
+        return img
+    scale = max_edge / max(h, w)
+    logger.debug("Downscaling image from %sx%s by %.3f", w, h, scale)
+    return cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+def crop_eye_regions_mediapipe(image_input, max_faces=1):
+    """
+    Extract the eye region of up to max_faces faces from an image using MediaPipe Face Mesh.
+    Accepts a file path, a file-like object, or a decoded BGR image array.
+    Returns a list of (cropped eye region, bounding box) tuples, one per detected face.
     """
     try:
-        if isinstance(image_input, str):
-            logger.debug(f"Loading image from {image_input}")
-            img = cv2.imread(image_input)
-        else:
-            logger.debug("Loading image from file-like object")
-            file_bytes = np.asarray(bytearray(image_input.read()), dtype=np.uint8)
-            img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        
+        # Detector cost scales with pixel count; group photos keep more resolution for small faces
+        max_edge = MAX_IMAGE_EDGE if max_faces == 1 else MAX_GROUP_IMAGE_EDGE
+        img = load_image(image_input, max_edge)
         if img is None:
             logger.error({"message": "Failed to load image"})
-            return None, None
+            return []
+        img = downscale_image(img, max_edge)
         
-        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        with mp.solutions.face_mesh.FaceMesh(max_num_faces=1, min_detection_confidence=0.5) as face_mesh:
-            results = face_mesh.process(rgb_img)
-            if results.multi_face_landmarks:
-                logger.debug("Face landmarks detected")
-                landmarks = results.multi_face_landmarks[0].landmark
-                h, w, _ = img.shape
-                left_eye = [33, 133, 160, 159, 158, 157, 173]
-                right_eye = [362, 382, 387, 386, 385, 384, 398]
-                
-                x_coords = [landmark.x * w for landmark in landmarks for idx in left_eye + right_eye if landmark == landmarks[idx]]
-                y_coords = [landmark.y * h for landmark in landmarks for idx in left_eye + right_eye if landmark == landmarks[idx]]
-                
-                x_min = max(0, int(min(x_coords)) - 10)
-                x_max = min(w, int(max(x_coords)) + 10)
-                y_min = max(0, int(min(y_coords)) - 5)
-                y_max = min(h, int(max(y_coords)) + 5)
-                
-                logger.debug(f"Eye region cropped: x_min={x_min}, x_max={x_max}, y_min={y_min}, y_max={y_max}")
-                return img[y_min:y_max, x_min:x_max], (x_min, y_min, x_max, y_max)
-            
+        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=_rgb_scratch(img))
+        results = get_face_mesh(max_faces).process(rgb_img)
+        if not results.multi_face_landmarks:
             logger.warning({"message": "No face landmarks detected"})
-            return None, None
+            return []
+            
+        logger.debug("Face landmarks detected for %s faces", len(results.multi_face_landmarks))
+        h, w, _ = img.shape
+        regions = []
+        for face_landmarks in results.multi_face_landmarks:
+            landmarks = face_landmarks.landmark
+            points = np.array([(landmarks[i].x, landmarks[i].y) for i in _EYE_IDX], dtype=np.float32)
+            x_coords = points[:, 0] * w
+            y_coords = points[:, 1] * h
+            
+            x_min = max(0, int(x_coords.min()) - 10)
+            x_max = min(w, int(x_coords.max()) + 10)
+            y_min = max(0, int(y_coords.min()) - 5)
+            y_max = min(h, int(y_coords.max()) + 5)
+                
+            logger.debug("Eye region cropped: x_min=%s, x_max=%s, y_min=%s, y_max=%s", x_min, x_max, y_min, y_max)
+            regions.append((img[y_min:y_max, x_min:x_max], (x_min, y_min, x_max, y_max)))
+        return regions
     except Exception as e:
         logger.error({"error": str(e), "message": "Failed to crop eye region"})
+        return []
+
+def crop_both_eyes_region_mediapipe(image_input):
+    """
+    Extract eye region from an image using MediaPipe Face Mesh.
+    Accepts a file path, a file-like object, or a decoded BGR image array.
+    Returns cropped eye region and bounding box coordinates.
+    """
+    regions = crop_eye_regions_mediapipe(image_input, max_faces=1)
+    if not regions:
         return None, None
+    return regions[0]
+
+def embed_eye_regions(eye_regions, model_name=DEEPFACE_MODEL, batch_size=32):
+    """
+    Embed preprocessed eye regions with one batched forward pass of the recognition model, run by
+    ONNX Runtime when an export is available and by the DeepFace Keras model otherwise.
+    Returns an (N, D) array of embeddings in input order.
+    """
+    session = get_onnx_session(model_name)
+    if session is not None:
+        model_input = session.get_inputs()[0]
+        height, width = model_input.shape[1], model_input.shape[2]
+    else:
+        model = get_face_model(model_name)
+        width, height = model.input_shape
+    # Same resize/normalization DeepFace.represent applies per image, stacked into one (B, H, W, 3) tensor.
+    # Face detection is skipped: the inputs are already cropped eye regions.
+    batch = np.concatenate([
+        preprocessing.normalize_input(
+            img=preprocessing.resize_image(img=region[:, :, ::-1], target_size=(height, width)),
+            normalization="base"
+        )
+        for region in eye_regions
+    ], axis=0)
+    if session is not None:
+        batch = batch.astype(np.float32, copy=False)
+        return np.concatenate([
+            session.run(None, {model_input.name: batch[start:start + batch_size]})[0]
+            for start in range(0, len(batch), batch_size)
+        ], axis=0)
+    return np.asarray(model.model.predict(batch, batch_size=batch_size, verbose=0))
 
 def extract_embedding(image_input, model_name=DEEPFACE_MODEL):
     """
     Extract embedding from the eye region of an image.
-    Returns embedding and error message (if any).
+    Returns the embedding as a C-contiguous (D,) float32 array, its bounding box, and error message (if any).
     """
     try:
-        logger.info(f"Extracting embedding for image")
-        eye_region, bbox = crop_both_eyes_region_mediapipe(image_input)
+        logger.info("Extracting embedding for image")
+        eye_region, bbox = _crop_executor.submit(crop_both_eyes_region_mediapipe, image_input).result()
         if eye_region is None:
             logger.warning({"message": "Failed to detect eye region"})
             return None, None, "Failed to detect eye region"
@@ -85,14 +249,140 @@ def extract_embedding(image_input, model_name=DEEPFACE_MODEL):
             logger.warning({"message": "Failed to preprocess eye region"})
             return None, None, "Failed to preprocess eye region"
 
-        embedding = DeepFace.represent(
-            img_path=eye_region,
-            model_name=model_name,
-            enforce_detection=False
-        )[0]["embedding"]
-        embedding = np.array(embedding)
-        logger.info({"message": "Embedding extracted successfully", "embedding_shape": embedding.shape})
+        if get_onnx_session(model_name) is not None:
+            embedding = np.ascontiguousarray(embed_eye_regions([eye_region], model_name)[0], dtype=np.float32)
+        else:
+            # DeepFace.represent reuses DeepFace's cached model, which get_face_model() has warmed up
+            get_face_model(model_name)
+            embedding = DeepFace.represent(
+                img_path=eye_region,
+                model_name=model_name,
+                enforce_detection=False
+            )[0]["embedding"]
+            embedding = np.array(embedding, dtype=np.float32)
+        logger.info("Embedding extracted successfully, shape: %s", embedding.shape)
         return embedding, bbox, None
     except Exception as e:
         logger.error({"error": str(e), "message": "Embedding extraction failed"})
-        return None, None, f"Embedding extraction failed: {str(e)}"
\ No newline at end of file
+        return None, None, f"Embedding extraction failed: {str(e)}"
+
+def _crop_and_preprocess(image_input):
+    """Crop and preprocess the eye region of one image. Returns (eye region, error message)."""
+    eye_region, _ = crop_both_eyes_region_mediapipe(image_input)
+    if eye_region is None:
+        return None, "Failed to detect eye region"
+    eye_region = preprocess_eye_region(eye_region)
+    if eye_region is None:
+        return None, "Failed to preprocess eye region"
+    return eye_region, None
+
+def extract_embeddings_batch(image_inputs, model_name=DEEPFACE_MODEL, batch_size=32, executor=None):
+    """
+    Extract eye region embeddings for several images with one batched forward pass.
+    Images are cropped in parallel on executor (a small shared thread pool by default) before the crops are stacked.
+    Returns a list of (float32 embedding, error message) tuples in the same order as image_inputs.
+    """
+    results = [(None, None)] * len(image_inputs)
+    try:
+        logger.info({"count": len(image_inputs), "message": "Extracting embeddings for image batch"})
+        faces, positions = [], []
+        for i, (eye_region, error) in enumerate((executor or _crop_executor).map(_crop_and_preprocess, image_inputs)):
+            if eye_region is None:
+                results[i] = (None, error)
+                continue
+            faces.append(eye_region)
+            positions.append(i)
+
+        if not faces:
+            logger.warning({"message": "No eye regions detected in image batch"})
+            return results
+
+        embeddings = np.ascontiguousarray(embed_eye_regions(faces, model_name, batch_size), dtype=np.float32)
+        for position, embedding in zip(positions, embeddings):
+            results[position] = (embedding, None)
+        logger.info({"count": len(faces), "embedding_shape": embeddings.shape, "message": "Batch embeddings extracted successfully"})
+        return results
+    except Exception as e:
+        logger.error({"error": str(e), "message": "Batch embedding extraction failed"})
+        message = f"Embedding extraction failed: {str(e)}"
+        return [(embedding, error) if embedding is not None or error else (None, message) for embedding, error in results]
+
+def extract_embeddings_parallel(image_inputs, max_workers=None, model_name=DEEPFACE_MODEL, batch_size=32):
+    """
+    Extract eye region embeddings for a large set of images, e.g. a course's training directory,
+    cropping on max_workers threads (one per CPU by default) and embedding in one batched pass.
+    The model is only called from the calling thread, so it needs no lock.
+    Returns a list of (embedding, error message) tuples in the same order as image_inputs.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    logger.debug("Cropping %s images on %s threads", len(image_inputs), max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="eye-crop-bulk") as executor:
+        return extract_embeddings_batch(image_inputs, model_name, batch_size, executor=executor)
+
+def extract_face_embeddings(image_input, max_faces=MAX_FACES_PER_IMAGE, model_name=DEEPFACE_MODEL):
+    """
+    Extract eye region embeddings for every face (up to max_faces) in a single or group photo.
+    Returns an (N, D) float32 embedding array, the N bounding boxes, and error message (if any).
+    """
+    try:
+        logger.info("Extracting embeddings for all faces in image")
+        regions = _crop_executor.submit(crop_eye_regions_mediapipe, image_input, max_faces).result()
+        if not regions:
+            logger.warning({"message": "Failed to detect eye region"})
+            return None, [], "Failed to detect eye region"
+        
+        eye_regions, bboxes = [], []
+        for eye_region, bbox in regions:
+            eye_region = preprocess_eye_region(eye_region)
+            if eye_region is not None:
+                eye_regions.append(eye_region)
+                bboxes.append(bbox)
+        if not eye_regions:
+            logger.warning({"message": "Failed to preprocess eye region"})
+            return None, [], "Failed to preprocess eye region"
+        
+        embeddings = np.ascontiguousarray(embed_eye_regions(eye_regions, model_name), dtype=np.float32)
+        logger.info("Face embeddings extracted successfully, shape: %s", embeddings.shape)
+        return embeddings, bboxes, None
+    except Exception as e:
+        logger.error({"error": str(e), "message": "Embedding extraction failed"})
+        return None, [], f"Embedding extraction failed: {str(e)}"
+
+def read_image_bytes(image_input) -> bytes:
+    """Return the encoded bytes of an image given as a file path or a file-like object."""
+    if isinstance(image_input, str):
+        with open(image_input, "rb") as f:
+            return f.read()
+    return image_input.read()
+
+def image_digest(image_bytes) -> bytes:
+    """Content hash identifying an encoded image in the embedding and match caches."""
+    return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+def cached_extraction(extract, image_input, *args, image_bytes=None, digest=None):
+    """
+    Run extract(image_input, *args), e.g. extract_embedding or extract_face_embeddings, reusing the
+    result for an image whose encoded bytes were seen recently (retries, duplicate submissions, the
+    same photo for several courses). Pass image_bytes (and its image_digest, if already computed)
+    when image_input is already decoded or read; decoded arrays without their bytes are not cached.
+    """
+    if EMBEDDING_CACHE_SIZE <= 0 or (image_bytes is None and isinstance(image_input, np.ndarray)):
+        return extract(image_input, *args)
+    if image_bytes is None:
+        image_bytes = read_image_bytes(image_input)
+        image_input = io.BytesIO(image_bytes)
+    key = (extract.__name__, args, digest or image_digest(image_bytes))
+    with _embedding_cache_lock:
+        result = _embedding_cache.get(key)
+        if result is not None:
+            _embedding_cache.move_to_end(key)
+    if result is not None:
+        logger.debug("Reusing cached %s result for image", extract.__name__)
+        return result
+    result = extract(image_input, *args)
+    if result[0] is not None:
+        with _embedding_cache_lock:
+            _embedding_cache[key] = result
+            while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+                _embedding_cache.popitem(last=False)
+    return result
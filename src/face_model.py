@@ -0,0 +1,82 @@
+import os
+import numpy as np
+from functools import lru_cache
+from deepface import DeepFace
+from src.config import DEEPFACE_MODEL, USE_ONNX_RUNTIME, get_onnx_model_path
+from src.logger import get_logger
+
+try:
+    import onnxruntime as ort
+except ImportError:  # ONNX Runtime is optional; the Keras model is used instead
+    ort = None
+
+# Configure logging
+logger = get_logger(__name__)
+
+@lru_cache(maxsize=None)
+def get_face_model(model_name=DEEPFACE_MODEL):
+    """
+    Build the DeepFace recognition model once per process and warm it up.
+    A dummy forward pass triggers graph tracing and kernel selection, so the first
+    registration or attendance request does not pay that cost.
+    """
+    try:
+        logger.debug("Building and warming up %s model", model_name)
+        model = DeepFace.build_model(model_name)
+        target_size = model.input_shape
+        model.model.predict(np.zeros((1, target_size[1], target_size[0], 3), dtype=np.float32), verbose=0)
+        logger.info({"model": model_name, "message": "Face recognition model loaded and warmed up"})
+        return model
+    except Exception as e:
+        logger.error({"model": model_name, "error": str(e), "message": "Failed to load face recognition model"})
+        raise
+
+@lru_cache(maxsize=None)
+def get_onnx_session(model_name=DEEPFACE_MODEL):
+    """
+    Return a warmed-up ONNX Runtime session for the recognition model, with all graph optimizations
+    enabled, or None when onnxruntime is not installed, USE_ONNX_RUNTIME is off or the model has not
+    been exported (see export_onnx_model). Callers then fall back to get_face_model().
+    """
+    model_path = get_onnx_model_path(model_name)
+    if ort is None or not USE_ONNX_RUNTIME or not os.path.exists(model_path):
+        return None
+    try:
+        logger.debug("Loading ONNX Runtime session for %s from %s", model_name, model_path)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        model_input = session.get_inputs()[0]
+        session.run(None, {model_input.name: np.zeros((1, model_input.shape[1], model_input.shape[2], 3), dtype=np.float32)})
+        logger.info({"model": model_name, "path": model_path, "message": "ONNX Runtime face recognition model loaded and warmed up"})
+        return session
+    except Exception as e:
+        logger.error({"model": model_name, "error": str(e), "message": "Failed to load ONNX Runtime model, using Keras"})
+        return None
+
+def export_onnx_model(model_name=DEEPFACE_MODEL, quantize=False) -> str:
+    """
+    Export the Keras recognition model to ONNX at get_onnx_model_path(model_name). Needs tf2onnx and
+    onnxruntime; run it once per deployment, later processes then pick the export up through get_onnx_session.
+    The float32 export reproduces the Keras model's embeddings, so students registered with either
+    backend stay comparable. quantize=True adds int8 dynamic quantization of the weights, which shifts
+    the embedding space: only use it for a fresh database, or re-register every student afterwards.
+    Returns the path written.
+    """
+    import tensorflow as tf
+    import tf2onnx
+    model = get_face_model(model_name)
+    target_size = model.input_shape
+    model_path = get_onnx_model_path(model_name)
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    fp32_path = model_path + ".fp32" if quantize else model_path
+    spec = (tf.TensorSpec((None, target_size[1], target_size[0], 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model.model, input_signature=spec, output_path=fp32_path)
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(fp32_path, model_path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+    logger.info({"model": model_name, "path": model_path, "quantized": quantize, "message": "Exported face recognition model to ONNX"})
+    if quantize:
+        logger.warning({"model": model_name, "message": "Quantized ONNX embeddings differ from the Keras ones; re-register existing students"})
+    return model_path
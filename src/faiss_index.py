@@ -1,15 +1,27 @@
 import numpy as np
 import faiss
 import os
-import warnings
-from src.config import get_faiss_index_path, EMBEDDING_DIM
+import json
+import atexit
+import logging
+import threading
+import weakref
+from src.config import get_faiss_index_path, get_faiss_meta_path, EMBEDDING_DIM, HNSW_MIN_VECTORS, FAISS_SMALL_INDEX_SQ8, FAISS_INDEX_FACTORY, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH, FAISS_IVF_NPROBE, FAISS_MMAP_INDEXES
 from src.logger import get_logger
 
 # Configure logging
 logger = get_logger(__name__)
 
-# Ignore warnings
-warnings.filterwarnings("ignore")
+# Live FaissIndex instances, flushed at interpreter exit; weak, so discarded indexes can be freed
+_open_indices = weakref.WeakSet()
+
+@atexit.register
+def _flush_open_indices():
+    """Persist incremental additions that were never flushed, for every index still alive at exit."""
+    for index in list(_open_indices):
+        index.flush()
+
+
 
 class FaissIndex:
     """
@@ -19,14 +31,96 @@ class FaissIndex:
         """Initialize FAISS index dictionary."""
         try:
             logger.debug("Initializing FaissIndex")
-            self.indices = {}  # Dictionary to store course_id -> (index, student_ids, names)
+            self.indices = {}  # Dictionary to store course_id -> (index, {student_id: name})
+            self.tokens = {}  # course_id -> students-table freshness token the index was built against
+            self.dirty = set()  # course_ids with in-memory additions not yet written to disk
+            # Every Streamlit session shares one FaissIndex; FAISS objects must not be searched while
+            # they are added to or replaced, so all access to self.indices goes through this lock
+            self._lock = threading.RLock()
+            # Incremental additions are only persisted by flush(); make sure they survive a normal exit
+            _open_indices.add(self)
             self.dimension = EMBEDDING_DIM
+            self.index_factory = FAISS_INDEX_FACTORY
             logger.info({"message": "FaissIndex initialized successfully"})
         except Exception as e:
             logger.error({"error": str(e), "message": "Failed to initialize FaissIndex"})
             raise
 
-    def build_index(self, embeddings: np.ndarray, student_ids: list, names: list, course_id: str):
+    def _create_index(self, normalized: np.ndarray = None):
+        """
+        Create an empty, trained FAISS index suited to the vectors it will hold.
+
+        Embeddings are L2-normalized, so inner product equals cosine similarity. Small courses use
+        an exhaustive scan, over 8-bit scalar-quantized codes with FAISS_SMALL_INDEX_SQ8 (a quarter of
+        the memory traffic of float32) or else an exact IndexFlatIP; large ones use self.index_factory
+        (an HNSW graph over 8-bit scalar-quantized codes by default, or e.g. an IVF-PQ index), trained
+        on their own embeddings. Either is wrapped in an IndexIDMap2, so searches return student IDs and the IDs are persisted
+        with the index.
+        """
+        num_vectors = 0 if normalized is None else len(normalized)
+        if num_vectors > HNSW_MIN_VECTORS:
+            logger.debug("Creating '%s' index for %s embeddings", self.index_factory, num_vectors)
+            index = faiss.index_factory(self.dimension, self.index_factory, faiss.METRIC_INNER_PRODUCT)
+            if isinstance(index, faiss.IndexHNSW):
+                index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            if not index.is_trained:
+                index.train(normalized)
+            self._configure_search(index)
+        elif FAISS_SMALL_INDEX_SQ8:
+            index = faiss.IndexScalarQuantizer(self.dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            # Components of unit vectors lie in [-1, 1]; training on that fixed range instead of the
+            # course's own vectors lets an empty index take incremental additions without retraining
+            bounds = np.vstack([-np.ones(self.dimension), np.ones(self.dimension)]).astype(np.float32)
+            index.train(bounds)
+        else:
+            index = faiss.IndexFlatIP(self.dimension)
+        return faiss.IndexIDMap2(index)
+
+    @staticmethod
+    def _configure_search(index):
+        """Apply query-time parameters to an index, e.g. after creating or loading it."""
+        if isinstance(index, faiss.IndexIDMap):
+            index = faiss.downcast_index(index.index)
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = FAISS_IVF_NPROBE
+
+    def _promote_if_large(self, course_id: str):
+        """
+        Rebuild a course's exhaustive-scan index as a self.index_factory index once incremental
+        additions take it past HNSW_MIN_VECTORS, training the new index on the vectors already stored.
+        Callers hold self._lock.
+        """
+        index, names_by_id = self.indices[course_id]
+        inner = faiss.downcast_index(index.index)
+        if not isinstance(inner, (faiss.IndexFlat, faiss.IndexScalarQuantizer)) or index.ntotal <= HNSW_MIN_VECTORS:
+            return
+        logger.debug("Promoting FAISS index for course %s to '%s' at %s embeddings", course_id, self.index_factory, index.ntotal)
+        vectors = inner.reconstruct_n(0, inner.ntotal)
+        promoted = self._create_index(vectors)
+        promoted.add_with_ids(vectors, faiss.vector_to_array(index.id_map))
+        self.indices[course_id] = (promoted, names_by_id)
+
+    def is_exact(self, course_id: str) -> bool:
+        """Return True if a course's index scores exact float32 inner products (an IndexFlatIP)."""
+        with self._lock:
+            index, _ = self.indices.get(course_id, (None, {}))
+            return index is not None and isinstance(faiss.downcast_index(index.index), faiss.IndexFlat)
+
+    @staticmethod
+    def _indexed_ids(index) -> list:
+        """Return the student IDs stored in an IndexIDMap2, in insertion order."""
+        return faiss.vector_to_array(index.id_map).tolist()
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """Return a float32, C-contiguous, L2-normalized copy of a (N, D) embedding matrix."""
+        normalized = np.array(embeddings, dtype=np.float32, order="C", copy=True)
+        faiss.normalize_L2(normalized)
+        return normalized
+
+    def build_index(self, embeddings: np.ndarray, student_ids: list, names: list, course_id: str, token: tuple = None):
         """
         Build and save a FAISS index for a specific course from student embeddings.
         
@@ -35,9 +129,10 @@ class FaissIndex:
             student_ids (list): List of student IDs (integers).
             names (list): List of student names.
             course_id (str): Course identifier.
+            token (tuple): Database.student_state_token after the students were written, saved in the sidecar.
         """
         try:
-            logger.debug(f"Building FAISS index for course {course_id} with {len(embeddings)} embeddings")
+            logger.debug("Building FAISS index for course %s with %s embeddings", course_id, len(embeddings))
             if embeddings.size == 0:
                 logger.warning({"course_id": course_id, "message": "No embeddings provided to build FAISS index"})
                 return
@@ -54,43 +149,132 @@ class FaissIndex:
                 logger.error({"got": embeddings.shape[1], "expected": self.dimension, "message": f"Embedding dimension mismatch for course {course_id}"})
                 raise ValueError(f"Embedding dimension must be {self.dimension}")
             
-            index = faiss.IndexFlatL2(self.dimension)
-            index.add(embeddings)
-            self.indices[course_id] = (index, student_ids, names)
-            
-            index_path = get_faiss_index_path(course_id)
-            os.makedirs(os.path.dirname(index_path), exist_ok=True)
-            faiss.write_index(index, index_path)
-            logger.info({"course_id": course_id, "message": f"FAISS index built and saved to {index_path}", "embedding_count": len(embeddings)})
+            # Built outside the lock, so courses hydrating on other threads build in parallel
+            normalized = self._normalize(embeddings)
+            ids = np.asarray(student_ids, dtype=np.int64)
+            index = self._create_index(normalized)
+            index.add_with_ids(normalized, ids)
+            with self._lock:
+                # Key names by the same Python ints FAISS hands back from search
+                self.indices[course_id] = (index, dict(zip(ids.tolist(), names)))
+                self.tokens[course_id] = token
+                self.save_index(course_id)
+            logger.info({"course_id": course_id, "message": "FAISS index built and saved", "embedding_count": len(embeddings)})
         except Exception as e:
             logger.error({"error": str(e), "message": f"Failed to build FAISS index for course {course_id}"})
             raise
 
-    def load_index(self, course_id: str):
+    def save_index(self, course_id: str):
+        """
+        Persist the FAISS index (which stores its student IDs) for a specific course to disk, with a
+        JSON sidecar holding student names and a freshness token so it can be reloaded without
+        touching the database.
+        
+        Args:
+            course_id (str): Course identifier.
+        """
+        with self._lock:
+            index, names_by_id = self.indices.get(course_id, (None, {}))
+            if index is None:
+                logger.warning({"course_id": course_id, "message": "No FAISS index to save for course"})
+                return
+            index_path = get_faiss_index_path(course_id)
+            meta_path = get_faiss_meta_path(course_id)
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            # Write beside the target and rename into place: the previous file may be memory-mapped by
+            # this or another process, and a crash mid-write must not leave a truncated index
+            faiss.write_index(index, index_path + ".tmp")
+            token = self.tokens.get(course_id)
+            with open(meta_path + ".tmp", "w") as f:
+                json.dump({"token": list(token) if token is not None else None, "names": [[student_id, name] for student_id, name in names_by_id.items()]}, f)
+            os.replace(index_path + ".tmp", index_path)
+            os.replace(meta_path + ".tmp", meta_path)
+            self.dirty.discard(course_id)
+        logger.debug("FAISS index for course %s saved to %s", course_id, index_path)
+
+    def flush(self, course_id: str = None):
+        """
+        Write courses with unsaved additions to disk. update_index and add_embeddings only mark a
+        course dirty, so call this after a batch of registrations; it also runs at interpreter exit.
+        If the process dies first nothing is lost: the stale sidecar token makes the next startup
+        rebuild the index from the database.
+        
+        Args:
+            course_id (str): Course to flush, or None for every dirty course.
+        """
+        with self._lock:
+            for dirty_course in [course_id] if course_id is not None else list(self.dirty):
+                if dirty_course in self.dirty:
+                    try:
+                        self.save_index(dirty_course)
+                    except Exception as e:
+                        logger.error({"error": str(e), "message": f"Failed to flush FAISS index for course {dirty_course}"})
+
+    def load_index(self, course_id: str, student_ids: list = None, names: list = None, token: tuple = None) -> bool:
         """
         Load FAISS index for a specific course from disk.
         
         Args:
             course_id (str): Course identifier.
+            student_ids (list): Student IDs the index is expected to hold, in any order.
+            names (list): Student names in the same order as student_ids.
+            token (tuple): Current Database.student_state_token. When given instead of student_ids,
+                the roster is restored from the sidecar if it was saved with the same token.
+        
+        Returns:
+            bool: True if an index holding exactly student_ids was loaded.
         """
         try:
-            index_path = get_faiss_index_path(course_id)
-            logger.debug(f"Attempting to load FAISS index for course {course_id} from {index_path}")
-            if os.path.exists(index_path):
-                index = faiss.read_index(index_path)
-                if index.d != self.dimension:
-                    logger.error({"got": index.d, "expected": self.dimension, "message": f"Dimension mismatch in loaded FAISS index for course {course_id}"})
-                    raise ValueError(f"Loaded index dimension {index.d} does not match expected {self.dimension}")
-                self.indices[course_id] = (index, [], [])  # Initialize with empty IDs and names
-                logger.info({"course_id": course_id, "message": f"FAISS index loaded from {index_path}"})
-            else:
+            with self._lock:
+                if student_ids is None and token is not None:
+                    meta_path = get_faiss_meta_path(course_id)
+                    meta = {}
+                    if os.path.exists(meta_path):
+                        with open(meta_path) as f:
+                            meta = json.load(f)
+                    if meta.get("token") != list(token) or "names" not in meta:
+                        logger.info({"course_id": course_id, "message": "FAISS index sidecar is missing or stale"})
+                        self.indices[course_id] = (None, {})
+                        return False
+                    student_ids = [student_id for student_id, _ in meta["names"]]
+                    names = [name for _, name in meta["names"]]
+                student_ids = list(student_ids or [])
+                names = list(names or [])
+                index_path = get_faiss_index_path(course_id)
+                logger.debug("Attempting to load FAISS index for course %s from %s", course_id, index_path)
+                if os.path.exists(index_path):
+                    # With FAISS_MMAP_INDEXES the stored codes stay in the page cache instead of being copied
+                    # into this process; additions still work, FAISS copies the data when it has to grow
+                    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY) if FAISS_MMAP_INDEXES else faiss.read_index(index_path)
+                    if index.d != self.dimension:
+                        logger.error({"got": index.d, "expected": self.dimension, "message": f"Dimension mismatch in loaded FAISS index for course {course_id}"})
+                        raise ValueError(f"Loaded index dimension {index.d} does not match expected {self.dimension}")
+                    if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                        logger.warning({"course_id": course_id, "message": "Loaded FAISS index predates normalized inner-product indexing"})
+                        self.indices[course_id] = (None, {})
+                        return False
+                    if not isinstance(index, faiss.IndexIDMap2):
+                        logger.warning({"course_id": course_id, "message": "Loaded FAISS index predates stored student IDs"})
+                        self.indices[course_id] = (None, {})
+                        return False
+                    if sorted(self._indexed_ids(index)) != sorted(student_ids) or len(student_ids) != len(names):
+                        logger.warning({"course_id": course_id, "ntotal": index.ntotal, "student_ids_count": len(student_ids), "message": "Loaded FAISS index does not match student roster"})
+                        self.indices[course_id] = (None, {})
+                        return False
+                    self._configure_search(index)
+                    self.indices[course_id] = (index, dict(zip(student_ids, names)))
+                    self.tokens[course_id] = token
+                    logger.info({"course_id": course_id, "message": f"FAISS index loaded from {index_path}", "embedding_count": index.ntotal})
+                    return True
                 logger.warning({"course_id": course_id, "message": f"No FAISS index found at {index_path}"})
-                self.indices[course_id] = (None, [], [])
+                self.indices[course_id] = (None, {})
+                return False
         except Exception as e:
             logger.error({"error": str(e), "message": f"Failed to load FAISS index for course {course_id}"})
-            self.indices[course_id] = (None, [], [])
+            self.indices[course_id] = (None, {})
+            return False
 
-    def update_index(self, embedding: np.ndarray, student_id: int, name: str, course_id: str):
+    def update_index(self, embedding: np.ndarray, student_id: int, name: str, course_id: str, token: tuple = None):
         """
         Add a new embedding to the FAISS index for a specific course.
         
@@ -99,9 +283,10 @@ class FaissIndex:
             student_id (int): Student ID.
             name (str): Student name.
             course_id (str): Course identifier.
+            token (tuple): Database.student_state_token after the student was written.
         """
         try:
-            logger.debug(f"Updating FAISS index for student_id: {student_id}, course_id: {course_id}")
+            logger.debug("Updating FAISS index for student_id: %s, course_id: %s", student_id, course_id)
             if not isinstance(embedding, np.ndarray):
                 logger.error({"type": type(embedding), "message": f"Invalid embedding type for student {student_id}"})
                 raise ValueError("Embedding must be a numpy array")
@@ -110,21 +295,64 @@ class FaissIndex:
                 logger.error({"got": embedding.shape[0], "expected": self.dimension, "message": f"Embedding dimension mismatch for student {student_id}"})
                 raise ValueError(f"Embedding dimension must match index dimension ({self.dimension})")
             
-            if course_id not in self.indices or self.indices[course_id][0] is None:
-                self.indices[course_id] = (faiss.IndexFlatL2(self.dimension), [], [])
-                logger.debug(f"Created new FAISS index for course {course_id} with dimension {self.dimension}")
+            normalized = self._normalize(embedding.reshape(1, -1))
+            with self._lock:
+                if course_id not in self.indices or self.indices[course_id][0] is None:
+                    self.indices[course_id] = (self._create_index(), {})
+                    logger.debug("Created new FAISS index for course %s with dimension %s", course_id, self.dimension)
+                
+                index, names_by_id = self.indices[course_id]
+                index.add_with_ids(normalized, np.array([student_id], dtype=np.int64))
+                names_by_id[student_id] = name
+                self._promote_if_large(course_id)
+                self.tokens[course_id] = token
+                self.dirty.add(course_id)
+                ntotal = self.indices[course_id][0].ntotal
+            logger.info("FAISS index updated (student_id=%s, course_id=%s, embedding_count=%s)", student_id, course_id, ntotal)
+        except Exception as e:
+            logger.error({"error": str(e), "message": f"Failed to update FAISS index for student {student_id} in course {course_id}"})
+
+    def add_embeddings(self, embeddings: np.ndarray, student_ids: list, names: list, course_id: str, token: tuple = None):
+        """
+        Add several new embeddings to the FAISS index for a specific course in one call.
+        
+        Args:
+            embeddings (np.ndarray): Array of new student embeddings, shape (N, D).
+            student_ids (list): List of student IDs (integers).
+            names (list): List of student names.
+            course_id (str): Course identifier.
+            token (tuple): Database.student_state_token after the students were written.
+        """
+        try:
+            logger.debug("Adding %s embeddings to FAISS index for course %s", len(student_ids), course_id)
+            if not isinstance(embeddings, np.ndarray):
+                logger.error({"type": type(embeddings), "message": "Invalid embeddings type"})
+                raise ValueError("Embeddings must be a numpy array")
             
-            index, student_ids, names = self.indices[course_id]
-            index.add(np.array([embedding], dtype=np.float32))
-            student_ids.append(student_id)
-            names.append(name)
-            self.indices[course_id] = (index, student_ids, names)
+            if embeddings.ndim != 2 or embeddings.shape[1] != self.dimension:
+                logger.error({"got": embeddings.shape, "expected": self.dimension, "message": f"Embedding dimension mismatch for course {course_id}"})
+                raise ValueError(f"Embedding dimension must match index dimension ({self.dimension})")
             
-            index_path = get_faiss_index_path(course_id)
-            faiss.write_index(index, index_path)
-            logger.info({"student_id": student_id, "course_id": course_id, "message": "FAISS index updated", "embedding_count": index.ntotal})
+            if embeddings.shape[0] != len(student_ids) or embeddings.shape[0] != len(names):
+                logger.error({"embeddings_count": embeddings.shape[0], "student_ids_count": len(student_ids), "names_count": len(names), "message": "Mismatch in lengths"})
+                raise ValueError("Embeddings, student_ids, and names must have the same length")
+            
+            normalized = self._normalize(embeddings)
+            with self._lock:
+                if course_id not in self.indices or self.indices[course_id][0] is None:
+                    self.indices[course_id] = (self._create_index(normalized), {})
+                    logger.debug("Created new FAISS index for course %s with dimension %s", course_id, self.dimension)
+                
+                index, names_by_id = self.indices[course_id]
+                index.add_with_ids(normalized, np.asarray(student_ids, dtype=np.int64))
+                names_by_id.update(zip(student_ids, names))
+                self._promote_if_large(course_id)
+                self.tokens[course_id] = token
+                self.dirty.add(course_id)
+                ntotal = self.indices[course_id][0].ntotal
+            logger.info("FAISS index updated (course_id=%s, added=%s, embedding_count=%s)", course_id, len(student_ids), ntotal)
         except Exception as e:
-            logger.error({"error": str(e), "message": f"Failed to update FAISS index for student {student_id} in course {course_id}"})
+            logger.error({"error": str(e), "message": f"Failed to add embeddings to FAISS index for course {course_id}"})
 
     def search(self, embedding: np.ndarray, course_id: str, k: int = 1):
         """
@@ -136,30 +364,33 @@ class FaissIndex:
             k (int): Number of nearest neighbors to return.
         
         Returns:
-            Tuple[np.ndarray, np.ndarray, list, list]: Distances, indices, student_ids, names.
+            Tuple[np.ndarray, np.ndarray, dict]: Cosine similarities (higher is closer), matched student IDs
+            (-1 where fewer than k students exist), and the course's {student_id: name} mapping.
         """
         try:
-            logger.debug(f"Searching FAISS index for course {course_id} with k={k}")
-            if course_id not in self.indices or self.indices[course_id][0] is None:
-                logger.warning({"course_id": course_id, "message": "FAISS index not initialized for course"})
-                return None, None, [], []
+            with self._lock:
+                logger.debug("Searching FAISS index for course %s with k=%s", course_id, k)
+                if course_id not in self.indices or self.indices[course_id][0] is None:
+                    logger.warning({"course_id": course_id, "message": "FAISS index not initialized for course"})
+                    return None, None, {}
             
-            index, student_ids, names = self.indices[course_id]
-            if index.ntotal == 0:
-                logger.warning({"course_id": course_id, "message": "FAISS index is empty for course"})
-                return None, None, [], []
+                index, names_by_id = self.indices[course_id]
+                if index.ntotal == 0:
+                    logger.warning({"course_id": course_id, "message": "FAISS index is empty for course"})
+                    return None, None, {}
             
-            if not isinstance(embedding, np.ndarray):
-                logger.error({"type": type(embedding), "message": "Invalid embedding type"})
-                raise ValueError("Embedding must be a numpy array")
+                if not isinstance(embedding, np.ndarray):
+                    logger.error({"type": type(embedding), "message": "Invalid embedding type"})
+                    raise ValueError("Embedding must be a numpy array")
             
-            if embedding.shape[1] != self.dimension:
-                logger.error({"got": embedding.shape[1], "expected": self.dimension, "message": "Embedding dimension mismatch"})
-                raise ValueError(f"Embedding dimension must match index dimension ({self.dimension})")
+                if embedding.shape[1] != self.dimension:
+                    logger.error({"got": embedding.shape[1], "expected": self.dimension, "message": "Embedding dimension mismatch"})
+                    raise ValueError(f"Embedding dimension must match index dimension ({self.dimension})")
             
-            distances, indices = index.search(embedding, k)
-            logger.info({"course_id": course_id, "message": "FAISS search completed", "distances": distances.tolist(), "indices": indices.tolist()})
-            return distances, indices, student_ids, names
+                similarities, ids = index.search(self._normalize(embedding), k)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info({"course_id": course_id, "message": "FAISS search completed", "similarities": similarities.tolist(), "ids": ids.tolist()})
+                return similarities, ids, names_by_id
         except Exception as e:
             logger.error({"error": str(e), "message": f"FAISS search failed for course {course_id}"})
-            return None, None, [], []
\ No newline at end of file
+            return None, None, {}
\ No newline at end of file
@@ -1,20 +1,31 @@
+import atexit
 import logging
-import warnings
+import logging.handlers
+import queue
 import os
-from src.config import LOG_FILE
+from src.config import LOG_FILE, LOG_LEVEL
 
-# Ignore warnings
-warnings.filterwarnings("ignore")
+_listener = None
 
-# Ensure log directory exists
-os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-
-# Configure logging
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+def configure_logging():
+    """
+    Route all logging to LOG_FILE at LOG_LEVEL. Entry points call this once at startup; later calls
+    are no-ops. Callers only enqueue records, a listener thread writes them to the file.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    # Ensure log directory exists
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    _listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))  # The file handler adds time and level
+    logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
 
 def get_logger(name):
     """Return a logger instance."""
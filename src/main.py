@@ -1,17 +1,15 @@
 from src.db_setup import init_database
-from src.register_students import register_student
+from src.register_students import register_student, register_students_batched
 from src.mark_attendance import mark_attendance
 from src.extract_embeddings import extract_embedding
 from src.faiss_index import FaissIndex
-from src.config import get_train_images_dir, EMBEDDING_DIM, COURSES
+from src.config import get_input_images_dir, EMBEDDING_DIM, COURSES, SHOW_WARNINGS
 from src.database import Database
-from src.logger import get_logger
+from src.logger import get_logger, configure_logging
 import numpy as np
+import os
 import warnings
-from typing import Optional
-
-# Ignore warnings
-warnings.filterwarnings("ignore")
+from typing import Optional, List, Tuple
 
 # Configure logging
 logger = get_logger(__name__)
@@ -21,7 +19,7 @@ def fetch_and_display_students(db: Database, course_id: Optional[str] = None):
     Fetch and display all students from the database, optionally filtered by course.
     """
     try:
-        logger.debug(f"Fetching students from database, course_id: {course_id if course_id else 'all'}")
+        logger.debug("Fetching students from database, course_id: %s", course_id if course_id else 'all')
         students = db.fetch_students(course_id)
         if students is None:
             logger.warning({"message": "No students found or error occurred"})
@@ -42,7 +40,33 @@ def fetch_and_display_students(db: Database, course_id: Optional[str] = None):
         logger.error({"error": str(e), "message": "Failed to fetch student data"})
         print(f"Error: {str(e)}")
 
+def bootstrap_course(db: Database, course_id: str, images_dir: str, faiss_index: FaissIndex) -> List[Tuple[int, bool, str]]:
+    """
+    Register every image in images_dir named <roll number>_<full name>.jpg in one batch, the naming
+    the app saves registration uploads with (config.get_student_image_path). Images named only
+    <roll number>.jpg carry no name to register and are skipped; rename them to include one.
+    Embeddings are written to the database in a single transaction and added to the FAISS index at once.
+    """
+    students = []
+    for file_name in sorted(os.listdir(images_dir)):
+        stem, ext = os.path.splitext(file_name)
+        roll_part, _, name_part = stem.partition("_")
+        if ext.lower() not in (".jpg", ".jpeg", ".png") or not roll_part.isdigit() or not name_part.strip():
+            logger.warning({"file": file_name, "message": "Skipping file not named <roll number>_<full name>"})
+            print(f"Skipping {file_name}: not named <roll number>_<full name>")
+            continue
+        students.append((int(roll_part), name_part.strip(), os.path.join(images_dir, file_name)))
+    logger.debug("Bootstrapping course %s with %s images from %s", course_id, len(students), images_dir)
+    results = register_students_batched(db, students, course_id, COURSES[course_id], faiss_index, max_workers=os.cpu_count())
+    faiss_index.flush(course_id)
+    for student_id, success, message in results:
+        print(f"{student_id}: {message}")
+    return results
+
 def main():
+    configure_logging()
+    if not SHOW_WARNINGS:
+        warnings.filterwarnings("ignore")
     try:
         logger.debug("Starting main function")
         with Database() as db:
@@ -55,35 +79,35 @@ def main():
             
             course_id = "AI"
             course_name = COURSES[course_id]
-            image_path = os.path.join(get_train_images_dir(course_id), "1234.jpg")
+            image_path = os.path.join(get_input_images_dir(course_id), "1234.jpg")
             faiss_index = FaissIndex()
             
-            logger.debug(f"Fetching students for course {course_id}")
-            students = db.fetch_students(course_id)
-            if students:
-                logger.debug(f"Converting student embeddings to numpy array for course {course_id}")
-                embeddings = np.array([student['embedding'] for student in students], dtype=np.float32)
-                for i, emb in enumerate(embeddings):
-                    if emb.shape[0] != EMBEDDING_DIM:
-                        logger.error({"student_id": students[i]['id'], "course_id": course_id, "got": emb.shape[0], "expected": EMBEDDING_DIM, "message": "Unexpected embedding dimension in database"})
-                        print(f"Error: Unexpected embedding dimension {emb.shape[0]} for student {students[i]['id']}")
-                        return
-                student_ids = [student['id'] for student in students]
-                names = [student['name'] for student in students]
-                logger.debug(f"Building FAISS index for course {course_id} with {len(embeddings)} embeddings")
-                faiss_index.build_index(embeddings, student_ids, names, course_id)
+            token = db.student_state_token(course_id)
+            if token and token[0] and faiss_index.load_index(course_id, token=token):
+                logger.debug("Students of course %s unchanged, reusing the persisted FAISS index", course_id)
+            elif token and token[0]:
+                logger.debug("Fetching embedding matrix for course %s", course_id)
+                student_ids, names = db.fetch_student_roster(course_id)
+                embeddings = db.fetch_embedding_matrix(course_id)
+                if embeddings is None or len(embeddings) != len(student_ids):
+                    # No usable course matrix yet (e.g. a legacy database, or students skipped for
+                    # non-integer IDs): stack the per-student BLOBs
+                    student_ids, names, embeddings = db.fetch_students(course_id, return_matrix=True)
+                logger.debug("Building FAISS index for course %s with %s embeddings", course_id, len(embeddings))
+                faiss_index.build_index(embeddings, student_ids, names, course_id, token=token)
             else:
-                logger.debug(f"No students found for course {course_id}, loading empty FAISS index")
+                logger.debug("No students found for course %s, bootstrapping from %s", course_id, get_input_images_dir(course_id))
                 faiss_index.load_index(course_id)
+                bootstrap_course(db, course_id, get_input_images_dir(course_id), faiss_index)
             
-            logger.debug(f"Updating FAISS index with new student for course {course_id}")
+            logger.debug("Updating FAISS index with new student for course %s", course_id)
             embedding, _, error = extract_embedding(image_path)
             if embedding is not None:
                 if embedding.shape[0] != EMBEDDING_DIM:
                     logger.error({"got": embedding.shape[0], "expected": EMBEDDING_DIM, "message": "Unexpected embedding dimension from extract_embedding"})
                     print(f"Error: Unexpected embedding dimension {embedding.shape[0]}")
                     return
-                embedding = embedding.astype(np.float32)
+                embedding = np.ascontiguousarray(embedding, dtype=np.float32)
                 success, message = register_student(db, 1234, "John Doe", course_id, course_name, image_path, faiss_index)
                 if not success:
                     logger.error({"error": message, "message": "Failed to register student"})
@@ -94,7 +118,7 @@ def main():
                 print(f"Error: {error}")
                 return
             
-            logger.debug(f"Marking attendance with image: {image_path} for course {course_id}")
+            logger.debug("Marking attendance with image: %s for course %s", image_path, course_id)
             student_id, name, message = mark_attendance(db, image_path, faiss_index, course_id)
             logger.info({"message": message})
             print(message)
@@ -1,61 +1,335 @@
+import io
+import os
+import uuid
+import time
+import queue
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
 import numpy as np
-import warnings
-from typing import Tuple, Optional
+from typing import List, Tuple, Optional
 from datetime import datetime
-from src.extract_embeddings import extract_embedding
+from src.extract_embeddings import extract_embedding, extract_face_embeddings, cached_extraction, read_image_bytes, image_digest, decode_image
 from src.faiss_index import FaissIndex
-from src.config import FAISS_THRESHOLD, EMBEDDING_DIM, COURSES
+from src.utils import select_matches, rerank, attendance_timestamp
+from src.config import FAISS_SIM_THRESHOLD, EMBEDDING_DIM, VALID_COURSE_IDS, MAX_GROUP_IMAGE_EDGE, ATTENDANCE_AUDIT_DIR, SAVE_ATTENDANCE_IMAGES, SEARCH_BATCH_MAX_QUERIES, SEARCH_BATCH_WINDOW_MS, SEARCH_TIMEOUT_SECONDS, RERANK_CANDIDATES, MATCH_CACHE_SIZE, MATCH_CACHE_TTL_SECONDS
 from src.logger import get_logger
 
-# Ignore warnings
-warnings.filterwarnings("ignore")
-
 # Configure logging
 logger = get_logger(__name__)
 
+_STOP = object()  # queued by an index's finalizer to end its scheduler's worker
+
+class BatchedAttendanceScheduler:
+    """
+    Coalesces FAISS searches from concurrent attendance requests (e.g. several Streamlit sessions
+    sharing one FaissIndex). A lone request is searched at once; when more are already queued, the
+    worker thread keeps collecting for up to SEARCH_BATCH_WINDOW_MS or SEARCH_BATCH_MAX_QUERIES rows,
+    groups them by course and k and runs one batched search per group, handing each caller back its own rows.
+    """
+    def __init__(self, faiss_index: FaissIndex, max_queries: int = SEARCH_BATCH_MAX_QUERIES, window_ms: float = SEARCH_BATCH_WINDOW_MS):
+        # Only a weak reference, so a discarded index (e.g. a Streamlit cache clear) can still be freed;
+        # its finalizer stops the worker
+        self.faiss_index = weakref.ref(faiss_index)
+        self.max_queries = max_queries
+        self.window = window_ms / 1000.0
+        self.queue = queue.Queue()
+        weakref.finalize(faiss_index, self.queue.put, _STOP)
+        self.worker = threading.Thread(target=self._run, name="faiss-search-batch", daemon=True)
+        self.worker.start()
+
+    def submit(self, embeddings: np.ndarray, course_id: str, k: int = 1) -> Future:
+        """Queue (N, D) query embeddings; the future resolves to FaissIndex.search's result for them."""
+        future = Future()
+        self.queue.put((np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM), (course_id, k), future))
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            request = self.queue.get()
+            if request is _STOP:
+                return
+            pending = [request]
+            rows = len(request[0])
+            deadline = time.monotonic() + self.window
+            while rows < self.max_queries:
+                try:
+                    request = self.queue.get_nowait()
+                except queue.Empty:
+                    # Nothing else waiting means no concurrent load to batch with: search right away
+                    remaining = deadline - time.monotonic()
+                    if len(pending) == 1 or remaining <= 0:
+                        break
+                    try:
+                        request = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if request is _STOP:
+                    stopping = True
+                    break
+                pending.append(request)
+                rows += len(request[0])
+            by_search = {}
+            for request in pending:
+                by_search.setdefault(request[1], []).append(request)
+            for (course_id, k), requests in by_search.items():
+                self._search(course_id, k, requests)
+
+    def _search(self, course_id: str, k: int, requests: list):
+        try:
+            faiss_index = self.faiss_index()
+            if faiss_index is None:
+                raise RuntimeError("FAISS index was released")
+            queries = requests[0][0] if len(requests) == 1 else np.concatenate([embeddings for embeddings, _, _ in requests])
+            D, I, names_by_id = faiss_index.search(queries, course_id, k)
+            del faiss_index
+            logger.debug("Batched FAISS search for course %s: %s requests, %s queries", course_id, len(requests), len(queries))
+            start = 0
+            for embeddings, _, future in requests:
+                end = start + len(embeddings)
+                future.set_result((None, None, {}) if D is None else (D[start:end], I[start:end], names_by_id))
+                start = end
+        except Exception as e:
+            logger.error({"error": str(e), "message": f"Batched FAISS search failed for course {course_id}"})
+            for _, _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+
+_schedulers = weakref.WeakKeyDictionary()  # FaissIndex -> BatchedAttendanceScheduler, dropped with the index
+_schedulers_lock = threading.Lock()
+
+def _get_scheduler(faiss_index: FaissIndex) -> BatchedAttendanceScheduler:
+    """Return the search scheduler for a FaissIndex, starting it on first use."""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(faiss_index)
+        if scheduler is None:
+            scheduler = _schedulers[faiss_index] = BatchedAttendanceScheduler(faiss_index)
+        return scheduler
+
+# (course_id, group, image digest) -> (expiry, [(student_id, name), ...]) for recently matched images,
+# kept apart for single-face and group matching of the same image; every entry has the same TTL,
+# so insertion order is also expiry order
+_match_cache = OrderedDict()
+_match_cache_lock = threading.Lock()
+
+def _recent_matches(course_id: str, group: bool, digest: Optional[bytes]) -> Optional[List[Tuple[int, str]]]:
+    """Return the students matched in an identical image submitted for the course (in the same mode) within MATCH_CACHE_TTL_SECONDS."""
+    if digest is None or MATCH_CACHE_SIZE <= 0:
+        return None
+    now = time.monotonic()
+    with _match_cache_lock:
+        while _match_cache and next(iter(_match_cache.values()))[0] <= now:
+            _match_cache.popitem(last=False)
+        entry = _match_cache.get((course_id, group, digest))
+    return entry[1] if entry is not None else None
+
+def _remember_matches(course_id: str, group: bool, digest: Optional[bytes], matches: List[Tuple[int, str]]):
+    """Cache the students matched in an image so resubmissions skip embedding and search."""
+    if digest is None or not matches or MATCH_CACHE_SIZE <= 0:
+        return
+    with _match_cache_lock:
+        _match_cache.pop((course_id, group, digest), None)
+        _match_cache[(course_id, group, digest)] = (time.monotonic() + MATCH_CACHE_TTL_SECONDS, list(matches))
+        while len(_match_cache) > MATCH_CACHE_SIZE:
+            _match_cache.popitem(last=False)
+
+def _search_course(db, faiss_index: FaissIndex, embeddings: np.ndarray, course_id: str):
+    """
+    Match query embeddings against a course with FAISS, falling back to the sqlite-vec table
+    when the course has no usable FAISS index. Approximate (quantized or graph) indexes return a
+    RERANK_CANDIDATES shortlist that is re-scored against the stored embeddings, so the first
+    column is the best match either way. Returns (similarities, student IDs, names by ID);
+    raises TimeoutError if the search has not finished within SEARCH_TIMEOUT_SECONDS.
+    """
+    shortlist = RERANK_CANDIDATES if RERANK_CANDIDATES > 1 and not faiss_index.is_exact(course_id) else 1
+    try:
+        D, I, names_by_id = _get_scheduler(faiss_index).submit(embeddings, course_id, shortlist).result(timeout=SEARCH_TIMEOUT_SECONDS)
+    except TimeoutError:
+        logger.error({"course_id": course_id, "timeout": SEARCH_TIMEOUT_SECONDS, "message": "FAISS search timed out"})
+        raise TimeoutError("face search timed out, please try again")
+    if D is not None and shortlist > 1:
+        stored = db.fetch_embeddings(course_id, np.unique(I[I >= 0]).tolist())
+        if stored:
+            candidates = np.zeros(I.shape + (EMBEDDING_DIM,), dtype=np.float32)
+            for position, student_id in np.ndenumerate(I):
+                embedding = stored.get(int(student_id))
+                if embedding is not None:
+                    candidates[position] = embedding
+            ids = np.where(np.isin(I, list(stored)), I, -1)
+            D, I = rerank(np.ascontiguousarray(embeddings, dtype=np.float32), candidates, ids)
+    if D is None and db.vec_enabled:
+        logger.info({"course_id": course_id, "message": "FAISS index unavailable, searching with sqlite-vec"})
+        D, I = db.search_embeddings(course_id, embeddings)
+        names_by_id = dict(zip(*db.fetch_student_roster(course_id)))
+    return D, I, names_by_id
+
 def mark_attendance(db, image_input, faiss_index: FaissIndex, course_id: str) -> Tuple[Optional[int], Optional[str], str]:
     """
     Match an image's embedding against stored embeddings for a specific course and mark attendance.
-    Accepts a Database instance, image input (file path or file-like object), a FaissIndex instance, and course_id.
+    Accepts a Database instance, image input (file path, file-like object or decoded BGR array), a FaissIndex instance, and course_id.
     Returns student ID, name, and message.
     """
+    if course_id not in VALID_COURSE_IDS:
+        logger.warning({"course_id": course_id, "message": "Attendance requested for unknown course"})
+        return None, None, f"Unknown course {course_id}"
     try:
-        logger.debug(f"Starting attendance marking for image in course {course_id}")
-        embedding, _, error = extract_embedding(image_input)
-        if embedding is None:
-            logger.warning({"error": error, "message": "Attendance marking failed"})
-            return None, None, error
-        
-        students = db.fetch_students(course_id)
-        if not students:
-            logger.warning({"course_id": course_id, "message": "No students registered in course"})
-            return None, None, f"Sorry, you are not registered in this course"
-        
-        logger.info({"count": len(students), "message": f"Fetched student data for attendance in course {course_id}"})
-        
-        D, I, student_ids, names = faiss_index.search(np.array([embedding], dtype=np.float32), course_id)
-        if D is None or I is None:
-            logger.error({"course_id": course_id, "message": "FAISS search failed due to uninitialized index or dimension mismatch"})
-            return None, None, f"Sorry, you are not registered in this course"
-        
-        distance = D[0][0]
-        logger.debug(f"FAISS search result: distance={distance:.2f}, index={I[0][0]}")
-        
-        if distance < FAISS_THRESHOLD:
-            if I[0][0] >= len(student_ids):
-                logger.error({"index": I[0][0], "student_ids_length": len(student_ids), "message": "Invalid index returned by FAISS"})
-                return None, None, "FAISS search returned invalid index"
-            student_id = student_ids[I[0][0]]
-            name = names[I[0][0]]
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        logger.debug("Starting attendance marking for image in course %s", course_id)
+        image_bytes = digest = None
+        if not isinstance(image_input, np.ndarray):
+            image_bytes = read_image_bytes(image_input)
+            digest = image_digest(image_bytes)
+            image_input = io.BytesIO(image_bytes)
+        
+        recent = _recent_matches(course_id, False, digest)
+        if recent:
+            (student_id, name), = recent
+            similarity = None
+            logger.debug("Reusing recent match of student %s for image in course %s", student_id, course_id)
+        else:
+            embedding, _, error = cached_extraction(extract_embedding, image_input, image_bytes=image_bytes, digest=digest)
+            if embedding is None:
+                logger.warning({"error": error, "message": "Attendance marking failed"})
+                return None, None, error
+            
+            student_count = db.course_student_count(course_id)
+            if not student_count:
+                logger.warning({"course_id": course_id, "message": "No students registered in course"})
+                return None, None, f"Sorry, you are not registered in this course"
+            
+            logger.info("Matching against %s registered students in course %s", student_count, course_id)
+            
+            # extract_embedding returns a float32 C-contiguous (D,) array, so this is a (1, D) view, not a copy;
+            # the search only reads it, which keeps a cached embedding intact
+            D, I, names_by_id = _search_course(db, faiss_index, embedding.reshape(1, -1), course_id)
+            if D is None or I is None:
+                logger.error({"course_id": course_id, "message": "FAISS search failed due to uninitialized index or dimension mismatch"})
+                return None, None, f"Sorry, you are not registered in this course"
+            
+            # Convert the (1, 1) results to Python scalars once instead of indexing the arrays per use
+            similarity, student_id = D.item(0), I.item(0)
+            name = names_by_id.get(student_id)
+            logger.debug("FAISS search result: similarity=%.2f, student_id=%s", similarity, student_id)
+            
+            if similarity <= FAISS_SIM_THRESHOLD or name is None:
+                if similarity > FAISS_SIM_THRESHOLD:
+                    logger.error({"student_id": student_id, "course_id": course_id, "message": "Invalid student ID returned by FAISS"})
+                    return None, None, "FAISS search returned invalid index"
+                logger.warning({"similarity": similarity, "course_id": course_id, "message": f"No match found (similarity: {similarity:.2f})"})
+                return None, None, f"Sorry, you are not registered in this course"
+            _remember_matches(course_id, False, digest, [(student_id, name)])
+        
+        timestamp = attendance_timestamp()
+        success, message = db.mark_attendance(student_id, timestamp, course_id)
+        if success:
+            logger.info("Attendance marked for %s (student_id=%s, course_id=%s, similarity=%s)", name, student_id, course_id, similarity)
+            return student_id, name, f"Attendance marked for {name} (ID: {student_id}) in course {course_id}"
+        logger.error({"student_id": student_id, "course_id": course_id, "error": message, "message": "Attendance marking failed"})
+        return None, None, message
+    except Exception as e:
+        logger.error({"error": str(e), "message": f"Error during attendance marking in course {course_id}"})
+        return None, None, f"Error during attendance marking: {str(e)}"
+
+def mark_group_attendance(db, image_input, faiss_index: FaissIndex, course_id: str, image_bytes: Optional[bytes] = None) -> Tuple[List[Tuple[int, str]], str]:
+    """
+    Recognize every face in a single or group photo and mark attendance for each matched student.
+    All detected faces are matched with one batched FAISS query.
+    Accepts a Database instance, image input (file path, file-like object or decoded BGR array), a FaissIndex instance, and course_id;
+    pass the encoded image_bytes with a decoded array so repeated uploads reuse their embeddings and matches.
+    Returns the list of (student ID, name) marked present, and message.
+    """
+    if course_id not in VALID_COURSE_IDS:
+        logger.warning({"course_id": course_id, "message": "Attendance requested for unknown course"})
+        return [], f"Unknown course {course_id}"
+    try:
+        logger.debug("Starting group attendance marking for image in course %s", course_id)
+        if image_bytes is None and not isinstance(image_input, np.ndarray):
+            image_bytes = read_image_bytes(image_input)
+            image_input = io.BytesIO(image_bytes)
+        digest = image_digest(image_bytes) if image_bytes is not None else None
+        
+        matches = _recent_matches(course_id, True, digest)
+        if matches:
+            faces = len(matches)
+            logger.debug("Reusing %s recent matches for image in course %s", faces, course_id)
+        else:
+            embeddings, _, error = cached_extraction(extract_face_embeddings, image_input, image_bytes=image_bytes, digest=digest)
+            if embeddings is None:
+                logger.warning({"error": error, "message": "Attendance marking failed"})
+                return [], error
+            
+            if not db.course_student_count(course_id):
+                logger.warning({"course_id": course_id, "message": "No students registered in course"})
+                return [], f"Sorry, you are not registered in this course"
+            
+            D, I, names_by_id = _search_course(db, faiss_index, embeddings, course_id)
+            if D is None or I is None:
+                logger.error({"course_id": course_id, "message": "FAISS search failed due to uninitialized index or dimension mismatch"})
+                return [], f"Sorry, you are not registered in this course"
+            
+            similarities = np.ascontiguousarray(D[:, 0])
+            ids = np.ascontiguousarray(I[:, 0], dtype=np.int64)
+            faces = len(similarities)
+            # Closest face wins when the same student is matched more than once
+            accepted = select_matches(similarities, ids, FAISS_SIM_THRESHOLD)
+            logger.debug("FAISS group search: %s faces, %s matches", faces, len(accepted))
+            
+            matches = []
+            for face in accepted:
+                student_id = int(ids[face])
+                if student_id not in names_by_id:
+                    logger.error({"student_id": student_id, "course_id": course_id, "message": "Invalid student ID returned by FAISS"})
+                    continue
+                matches.append((student_id, names_by_id[student_id]))
+            _remember_matches(course_id, True, digest, matches)
+        
+        timestamp = attendance_timestamp()
+        marked, failures = [], []
+        for student_id, name in matches:
             success, message = db.mark_attendance(student_id, timestamp, course_id)
             if success:
-                logger.info({"student_id": student_id, "name": name, "course_id": course_id, "distance": distance, "message": f"Attendance marked for {name}"})
-                return student_id, name, f"Attendance marked for {name} (ID: {student_id}) in course {course_id}"
-            logger.error({"student_id": student_id, "course_id": course_id, "error": message, "message": "Attendance marking failed"})
-            return None, None, message
-        logger.warning({"distance": distance, "course_id": course_id, "message": f"No match found (distance: {distance:.2f})"})
-        return None, None, f"Sorry, you are not registered in this course"
+                marked.append((student_id, name))
+            else:
+                logger.error({"student_id": student_id, "course_id": course_id, "error": message, "message": "Attendance marking failed"})
+                failures.append(message)
+        
+        if not marked:
+            logger.warning({"faces": faces, "course_id": course_id, "message": "No match found in group photo"})
+            return [], failures[0] if failures else f"Sorry, you are not registered in this course"
+        
+        logger.info("Group attendance marked in course %s: %s faces, %s marked", course_id, faces, len(marked))
+        marked_names = ", ".join(f"{name} (ID: {student_id})" for student_id, name in marked)
+        return marked, f"Attendance marked for {marked_names} in course {course_id}"
+    except Exception as e:
+        logger.error({"error": str(e), "message": f"Error during attendance marking in course {course_id}"})
+        return [], f"Error during attendance marking: {str(e)}"
+
+def mark_attendance_from_bytes(db, image_bytes: bytes, faiss_index: FaissIndex, course_id: str) -> Tuple[List[Tuple[int, str]], str]:
+    """
+    Decode an uploaded single or group photo in memory and mark attendance for every recognized face,
+    without a temporary file on disk.
+    The raw upload is only written to ATTENDANCE_AUDIT_DIR when SAVE_ATTENDANCE_IMAGES is enabled.
+    Returns the list of (student ID, name) marked present, and message.
+    """
+    if course_id not in VALID_COURSE_IDS:
+        logger.warning({"course_id": course_id, "message": "Attendance requested for unknown course"})
+        return [], f"Unknown course {course_id}"
+    try:
+        logger.debug("Decoding %s byte attendance image for course %s", len(image_bytes), course_id)
+        img = decode_image(np.frombuffer(image_bytes, dtype=np.uint8), MAX_GROUP_IMAGE_EDGE)
+        if img is None:
+            logger.error({"course_id": course_id, "message": "Failed to decode attendance image"})
+            return [], "Failed to decode image"
+        
+        if SAVE_ATTENDANCE_IMAGES:
+            audit_path = os.path.join(ATTENDANCE_AUDIT_DIR, course_id, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jpg")
+            os.makedirs(os.path.dirname(audit_path), exist_ok=True)
+            with open(audit_path, "wb") as f:
+                f.write(image_bytes)
+            logger.info({"course_id": course_id, "message": f"Attendance image saved to {audit_path}"})
+        
+        return mark_group_attendance(db, img, faiss_index, course_id, image_bytes=image_bytes)
     except Exception as e:
         logger.error({"error": str(e), "message": f"Error during attendance marking in course {course_id}"})
-        return None, None, f"Error during attendance marking: {str(e)}"
\ No newline at end of file
+        return [], f"Error during attendance marking: {str(e)}"
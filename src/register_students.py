@@ -1,17 +1,26 @@
 import numpy as np
-import warnings
-from typing import Tuple
-from src.extract_embeddings import extract_embedding
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from src.extract_embeddings import extract_embedding, extract_embeddings_batch, extract_embeddings_parallel, cached_extraction
 from src.logger import get_logger
 from src.faiss_index import FaissIndex
-from src.config import EMBEDDING_DIM
-
-# Ignore warnings
-warnings.filterwarnings("ignore")
+from src.config import EMBEDDING_DIM, VALID_COURSE_IDS
 
 # Configure logging
 logger = get_logger(__name__)
 
+# Runs the duplicate check while the calling thread extracts the embedding; SQLite releases the GIL
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="register-db")
+
+def _l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Return float32 unit-length copies of one (D,) or several (N, D) embeddings. Students are stored
+    and indexed normalized, so inner product is cosine similarity everywhere; the input is left untouched
+    since it may be shared with the embedding cache.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / (np.linalg.norm(embeddings, axis=-1, keepdims=True) + 1e-12)
+
 def register_student(db, student_id: int, name: str, course_id: str, course_name: str, image_input, faiss_index: FaissIndex) -> Tuple[bool, str]:
     """
     Register a student by saving their ID, name, course details, and eye region embedding to the database,
@@ -19,13 +28,19 @@ def register_student(db, student_id: int, name: str, course_id: str, course_name
     Accepts a Database instance, image input (file path or file-like object), and a FaissIndex instance.
     Returns success status and message.
     """
+    if course_id not in VALID_COURSE_IDS:
+        logger.warning({"student_id": student_id, "course_id": course_id, "message": "Registration requested for unknown course"})
+        return False, f"Unknown course {course_id}"
     try:
-        logger.debug(f"Registering student {student_id}, name: {name}, course_id: {course_id}")
-        if db.check_duplicate(student_id, course_id):
+        logger.debug("Registering student %s, name: %s, course_id: %s", student_id, name, course_id)
+        # The embedding is extracted meanwhile; a duplicate's embedding is not wasted, the
+        # content-hash cache serves it if the upload is retried
+        duplicate = _db_executor.submit(db.check_duplicate, student_id, course_id)
+        embedding, _, error = cached_extraction(extract_embedding, image_input)
+        if duplicate.result():
             logger.error({"student_id": student_id, "course_id": course_id, "message": f"Student {student_id} already registered in course {course_id}"})
             return False, f"Student {student_id} is already registered in course {course_name}"
         
-        embedding, _, error = extract_embedding(image_input)
         if embedding is None:
             logger.warning({"error": error, "message": f"Registration failed for student {student_id} in course {course_id}"})
             return False, error
@@ -34,15 +49,75 @@ def register_student(db, student_id: int, name: str, course_id: str, course_name
             logger.error({"got": embedding.shape[0], "expected": EMBEDDING_DIM, "message": f"Unexpected embedding dimension for student {student_id}"})
             return False, f"Unexpected embedding dimension {embedding.shape[0]}, expected {EMBEDDING_DIM}"
         
+        embedding = _l2_normalize(embedding)
         success, message = db.register_student(student_id, name, course_id, course_name, embedding)
         if not success:
             logger.error({"student_id": student_id, "course_id": course_id, "message": message})
             return False, message
         
-        embedding = embedding.astype(np.float32)
-        faiss_index.update_index(embedding, student_id, name, course_id)
-        logger.info({"student_id": student_id, "course_id": course_id, "message": f"{message} and FAISS index updated"})
+        faiss_index.update_index(embedding, student_id, name, course_id, token=db.student_state_token(course_id))
+        logger.info("%s and FAISS index updated (student_id=%s, course_id=%s)", message, student_id, course_id)
         return True, f"{message} and FAISS index updated"
     except Exception as e:
         logger.error({"error": str(e), "message": f"Error registering student {student_id} in course {course_id}"})
-        return False, f"Error: {str(e)}"
\ No newline at end of file
+        return False, f"Error: {str(e)}"
+
+def register_students_batched(db, students: List[Tuple[int, str, object]], course_id: str, course_name: str, faiss_index: FaissIndex, max_workers: Optional[int] = None) -> List[Tuple[int, bool, str]]:
+    """
+    Register several students of one course at once: embeddings are extracted in a single batched
+    forward pass, rows are inserted in one transaction and the FAISS index is updated once.
+    Accepts a Database instance, a list of (student_id, name, image input) tuples, and a FaissIndex instance;
+    pass max_workers to crop large batches on a dedicated pool of that many threads.
+    Returns a (student_id, success, message) tuple per student, in input order.
+    """
+    if course_id not in VALID_COURSE_IDS:
+        logger.warning({"course_id": course_id, "message": "Registration requested for unknown course"})
+        return [(student_id, False, f"Unknown course {course_id}") for student_id, _, _ in students]
+    results = [None] * len(students)
+    try:
+        logger.debug("Registering %s students in batch for course_id: %s", len(students), course_id)
+        pending, seen = [], set()
+        for i, (student_id, name, image_input) in enumerate(students):
+            if student_id in seen:
+                logger.error({"student_id": student_id, "course_id": course_id, "message": f"Student {student_id} appears more than once in batch"})
+                results[i] = (False, f"Student {student_id} appears more than once in this upload")
+                continue
+            seen.add(student_id)
+            if db.check_duplicate(student_id, course_id):
+                logger.error({"student_id": student_id, "course_id": course_id, "message": f"Student {student_id} already registered in course {course_id}"})
+                results[i] = (False, f"Student {student_id} is already registered in course {course_name}")
+                continue
+            pending.append(i)
+        
+        image_inputs = [students[i][2] for i in pending]
+        extracted = extract_embeddings_parallel(image_inputs, max_workers) if max_workers else extract_embeddings_batch(image_inputs)
+        accepted, embeddings = [], []
+        for i, (embedding, error) in zip(pending, extracted):
+            student_id = students[i][0]
+            if embedding is None:
+                logger.warning({"error": error, "message": f"Registration failed for student {student_id} in course {course_id}"})
+                results[i] = (False, error)
+            elif embedding.shape[0] != EMBEDDING_DIM:
+                logger.error({"got": embedding.shape[0], "expected": EMBEDDING_DIM, "message": f"Unexpected embedding dimension for student {student_id}"})
+                results[i] = (False, f"Unexpected embedding dimension {embedding.shape[0]}, expected {EMBEDDING_DIM}")
+            else:
+                accepted.append(i)
+                embeddings.append(embedding)
+        
+        if accepted:
+            embeddings = _l2_normalize(np.stack(embeddings))
+            rows = [(students[i][0], students[i][1]) for i in accepted]
+            success, message = db.register_students_bulk(rows, course_id, course_name, embeddings)
+            if not success:
+                logger.error({"course_id": course_id, "message": message})
+                for i in accepted:
+                    results[i] = (False, message)
+            else:
+                faiss_index.add_embeddings(embeddings, [student_id for student_id, _ in rows], [name for _, name in rows], course_id, token=db.student_state_token(course_id))
+                for i, (student_id, name) in zip(accepted, rows):
+                    results[i] = (True, f"Student {name} (ID: {student_id}) registered successfully for {course_name} and FAISS index updated")
+                logger.info("%s and FAISS index updated (count=%s, course_id=%s)", message, len(rows), course_id)
+    except Exception as e:
+        logger.error({"error": str(e), "message": f"Error registering students in batch for course {course_id}"})
+        results = [result or (False, f"Error: {str(e)}") for result in results]
+    return [(student_id, *result) for (student_id, _, _), result in zip(students, results)]
@@ -1,30 +1,97 @@
 import os
+import time
+import shutil
+import secrets
 import cv2
 import numpy as np
 from src.logger import get_logger
 
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional; rerank and select_matches then use their NumPy versions
+    njit = None
+    prange = range
+
 # Configure logging
 logger = get_logger(__name__)
 
+# Uploads are streamed to disk in chunks of this size
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Upload directories known to exist, so save_image skips os.makedirs after the first write
+_created_dirs = set()
+
+# Zero-padded two-digit fields for timestamp formatting, and the last (second, timestamp) formatted
+_TWO_DIGITS = [f"{i:02d}" for i in range(100)]
+_last_timestamp = (None, None)
+
+def attendance_timestamp() -> str:
+    """
+    Return the current local time as "YYYY-MM-DD HH:MM:SS", the format attendance rows are stored in.
+    Equivalent to datetime.now().strftime(...) without the locale-aware formatting; the string is
+    reused for every call within the same second.
+    """
+    global _last_timestamp
+    second = int(time.time())
+    cached_second, timestamp = _last_timestamp
+    if second == cached_second:
+        return timestamp
+    t = time.localtime(second)
+    d = _TWO_DIGITS
+    timestamp = f"{t.tm_year}-{d[t.tm_mon]}-{d[t.tm_mday]} {d[t.tm_hour]}:{d[t.tm_min]}:{d[t.tm_sec]}"
+    _last_timestamp = (second, timestamp)
+    return timestamp
+
+def _ensure_dir(directory):
+    """Create a directory (and its parents) the first time it is written to in this process."""
+    if directory not in _created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _created_dirs.add(directory)
+
 def save_image(file, output_path):
     """
-    Save an uploaded image to the specified path.
+    Write an uploaded image to the specified path without copying it whole in memory: in-memory
+    uploads (BytesIO, e.g. Streamlit's UploadedFile) are written straight from their buffer, other
+    file objects are streamed in chunks. The image is written to a temporary file in the same
+    directory and renamed into place, so output_path never holds a partially written image, and
+    only if it decodes (at 1/8 scale for JPEGs), so corrupt or non-image uploads are rejected.
     Returns success status and message.
     """
+    tmp_path = None
     try:
-        logger.debug(f"Saving image to {output_path}")
-        file_bytes = np.asarray(bytearray(file.read()), dtype=np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        if img is None:
-            logger.error({"message": f"Failed to decode image from {output_path}"})
+        logger.debug("Saving image to %s", output_path)
+        directory = os.path.dirname(output_path)
+        _ensure_dir(directory)
+        # Streamlit reuses the same UploadedFile buffer across reruns, so always rewind first
+        file.seek(0)
+        # Created like open() would (mode 0o666 less the umask), unlike tempfile's 0600 files, and
+        # O_EXCL so concurrent uploads to the same directory never share a temporary file
+        candidate = os.path.join(directory, f".upload-{secrets.token_hex(8)}.tmp")
+        fd = os.open(candidate, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        tmp_path = candidate
+        with os.fdopen(fd, "wb") as dst:
+            if hasattr(file, "getbuffer"):
+                with file.getbuffer() as view:
+                    dst.write(view)
+            else:
+                shutil.copyfileobj(file, dst, COPY_CHUNK_SIZE)
+            size = dst.tell()
+        file.seek(0)
+        if size == 0:
+            os.unlink(tmp_path)
+            logger.error({"message": f"Empty upload, nothing saved to {output_path}"})
+            return False, "Uploaded image is empty"
+        if cv2.imread(tmp_path, cv2.IMREAD_REDUCED_GRAYSCALE_8) is None:
+            os.unlink(tmp_path)
+            logger.error({"message": f"Failed to decode image for {output_path}"})
             return False, "Failed to decode image"
         
-        logger.debug(f"Decoded image shape: {img.shape}")
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        cv2.imwrite(output_path, img)
-        logger.info({"message": f"Image saved to {output_path}"})
+        os.replace(tmp_path, output_path)
+        logger.info({"message": f"Image saved to {output_path}", "bytes": size})
         return True, f"Image saved to {output_path}"
     except Exception as e:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
         logger.error({"error": str(e), "message": f"Failed to save image to {output_path}"})
         return False, f"Failed to save image: {str(e)}"
 
@@ -33,11 +100,100 @@ def cleanup_temp_image(image_path):
     Delete a temporary image file.
     """
     try:
-        logger.debug(f"Attempting to delete temporary image: {image_path}")
-        if os.path.exists(image_path):
-            os.remove(image_path)
-            logger.info({"message": f"Temporary image deleted: {image_path}"})
-        else:
-            logger.warning({"message": f"Temporary image not found: {image_path}"})
+        logger.debug("Attempting to delete temporary image: %s", image_path)
+        # Unlink directly rather than checking first: one syscall, and no race with another deleter
+        os.unlink(image_path)
+        logger.info("Temporary image deleted: %s", image_path)
+    except FileNotFoundError:
+        logger.warning({"message": f"Temporary image not found: {image_path}"})
     except Exception as e:
-        logger.error({"error": str(e), "message": f"Failed to delete temporary image {image_path}"})
\ No newline at end of file
+        logger.error({"error": str(e), "message": f"Failed to delete temporary image {image_path}"})
+
+def rerank(queries, candidates, ids):
+    """
+    Re-score an approximate FAISS shortlist exactly.
+    queries is (Q, D), candidates (Q, K, D) holds the stored embeddings of each query's K shortlisted
+    students and ids their (Q, K) student IDs, -1 for empty slots. Scores are cosine similarities.
+    Returns (similarities, ids), both (Q, K) with each row most similar first; empty slots score -2.
+    """
+    return _rerank(queries, candidates, ids)
+
+def _rerank_loops(queries, candidates, ids):
+    """rerank as explicit loops for Numba, parallel over queries."""
+    num_queries, k = ids.shape
+    dim = queries.shape[1]
+    similarities = np.empty((num_queries, k), np.float32)
+    ranked_ids = np.empty((num_queries, k), np.int64)
+    for q in prange(num_queries):
+        query_norm = 0.0
+        for d in range(dim):
+            query_norm += queries[q, d] * queries[q, d]
+        query_norm = np.sqrt(query_norm) + 1e-12
+        scores = np.empty(k, np.float32)
+        for j in range(k):
+            if ids[q, j] < 0:
+                scores[j] = -2.0
+                continue
+            dot = 0.0
+            norm = 0.0
+            for d in range(dim):
+                dot += queries[q, d] * candidates[q, j, d]
+                norm += candidates[q, j, d] * candidates[q, j, d]
+            scores[j] = dot / (query_norm * (np.sqrt(norm) + 1e-12))
+        order = np.argsort(-scores)
+        for j in range(k):
+            similarities[q, j] = scores[order[j]]
+            ranked_ids[q, j] = ids[q, order[j]]
+    return similarities, ranked_ids
+
+def _rerank_vectorized(queries, candidates, ids):
+    """rerank with whole-array NumPy operations."""
+    dots = np.einsum('qd,qkd->qk', queries, candidates)
+    norms = (np.linalg.norm(queries, axis=1)[:, None] + 1e-12) * (np.linalg.norm(candidates, axis=2) + 1e-12)
+    scores = np.where(ids < 0, np.float32(-2.0), dots / norms).astype(np.float32)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+def select_matches(similarities, ids, threshold):
+    """
+    Pick the faces that matched a student from a batched FAISS k=1 search.
+    A face is accepted when its similarity is above threshold and it matched a student ID (not -1);
+    when several faces match the same student only the closest one is kept.
+    Returns the accepted face indices as an int64 array, most similar first.
+    """
+    return _select_matches(similarities, ids, threshold)
+
+def _select_matches_loops(similarities, ids, threshold):
+    """select_matches as explicit loops for Numba."""
+    order = np.argsort(-similarities)
+    accepted = np.empty(similarities.shape[0], np.int64)
+    count = 0
+    for face in order:
+        if similarities[face] <= threshold:
+            break
+        if ids[face] < 0:
+            continue
+        duplicate = False
+        for j in range(count):
+            if ids[accepted[j]] == ids[face]:
+                duplicate = True
+                break
+        if not duplicate:
+            accepted[count] = face
+            count += 1
+    return accepted[:count]
+
+def _select_matches_vectorized(similarities, ids, threshold):
+    """select_matches with whole-array NumPy operations."""
+    order = np.argsort(-similarities, kind="stable")
+    order = order[(similarities[order] > threshold) & (ids[order] >= 0)]
+    # np.unique reports each student's first, i.e. most similar, face in order
+    _, first = np.unique(ids[order], return_index=True)
+    return order[np.sort(first)].astype(np.int64)
+
+if njit is not None:
+    _rerank = njit(parallel=True, fastmath=True, cache=True)(_rerank_loops)
+    _select_matches = njit(cache=True)(_select_matches_loops)
+else:
+    _rerank = _rerank_vectorized
+    _select_matches = _select_matches_vectorized